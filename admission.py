@@ -0,0 +1,147 @@
+import os
+import math
+import time
+import logging
+import threading
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+ADMISSION_MAX_CONCURRENT = int(os.getenv("ADMISSION_MAX_CONCURRENT", "4"))
+ADMISSION_MAX_QUEUE = int(os.getenv("ADMISSION_MAX_QUEUE", "8"))
+ADMISSION_QUEUE_TIMEOUT = float(os.getenv("ADMISSION_QUEUE_TIMEOUT", "10"))
+ADMISSION_RETRY_AFTER = float(os.getenv("ADMISSION_RETRY_AFTER", "10"))
+
+class Rejected(Exception):
+    def __init__(self, message, status, retry_after):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+class Ticket:
+    def __init__(self, controller, username, deadline):
+        self.controller = controller
+        self.username = username
+        self.deadline = deadline
+        self.running = False
+        self.started = None
+        self.released = False
+
+    def wait(self):
+        self.controller.wait(self)
+
+    def release(self):
+        self.controller.release(self)
+
+class AdmissionController:
+    # Limits how many recommendation pipelines one process runs at once.
+    # A pipeline holds a ticket from the moment it is accepted: first as
+    # queued, then as running once a slot frees up. Each user can hold only
+    # one ticket, and a ticket that has not started by its deadline is
+    # dropped, so a burst turns into quick rejections rather than requests
+    # that pile up until the worker times out.
+    def __init__(self, max_concurrent=ADMISSION_MAX_CONCURRENT, max_queue=ADMISSION_MAX_QUEUE,
+                 queue_timeout=ADMISSION_QUEUE_TIMEOUT):
+        self.max_concurrent = max(1, max_concurrent)
+        self.max_queue = max(0, max_queue)
+        self.queue_timeout = queue_timeout
+        self.condition = threading.Condition()
+        self.users = set()
+        self.queued = 0
+        self.running = 0
+        self.average_duration = ADMISSION_RETRY_AFTER
+        self.counters = {'admitted': 0, 'rejected_user': 0, 'rejected_queue_full': 0, 'rejected_timeout': 0,
+                         'background_admitted': 0, 'background_skipped': 0}
+
+    def retry_after(self, ahead):
+        # Roughly when a slot should be free for a request that would have
+        # had to wait behind `ahead` others.
+        rounds = ahead // self.max_concurrent + 1
+        return max(1, math.ceil(self.average_duration * rounds))
+
+    def reserve(self, username):
+        key = username.lower()
+        with self.condition:
+            if key in self.users:
+                self.counters['rejected_user'] += 1
+                raise Rejected(f"Recommendations for {username} are already being generated", 429,
+                               self.retry_after(0))
+            if self.running >= self.max_concurrent and self.queued >= self.max_queue:
+                self.counters['rejected_queue_full'] += 1
+                raise Rejected("Too many recommendation requests in progress", 503,
+                               self.retry_after(self.queued + self.running))
+            self.users.add(key)
+            self.queued += 1
+        return Ticket(self, key, time.monotonic() + self.queue_timeout)
+
+    def wait(self, ticket):
+        # The deadline is checked even when a slot is free, so a ticket that
+        # sat in a job queue past it is not started late.
+        with self.condition:
+            while True:
+                remaining = ticket.deadline - time.monotonic()
+                if remaining <= 0:
+                    self.counters['rejected_timeout'] += 1
+                    self._drop(ticket)
+                    raise Rejected("Timed out waiting for a free recommendation slot", 503,
+                                   self.retry_after(self.queued + self.running))
+                if self.running < self.max_concurrent:
+                    break
+                self.condition.wait(remaining)
+            self.queued -= 1
+            self.running += 1
+            self.counters['admitted'] += 1
+            ticket.running = True
+            ticket.started = time.monotonic()
+
+    def try_acquire_background(self):
+        # Background work such as result cache refreshes only runs when a
+        # slot is free and nobody is queued for one; it is never queued and
+        # is not tied to a user, so it cannot block that user's own request.
+        with self.condition:
+            if self.running + self.queued >= self.max_concurrent:
+                self.counters['background_skipped'] += 1
+                return None
+            self.running += 1
+            self.counters['background_admitted'] += 1
+            ticket = Ticket(self, None, None)
+            ticket.running = True
+            ticket.started = time.monotonic()
+            return ticket
+
+    def release(self, ticket):
+        with self.condition:
+            if ticket.released:
+                return
+            if ticket.running:
+                duration = time.monotonic() - ticket.started
+                self.average_duration = 0.8 * self.average_duration + 0.2 * duration
+            self._drop(ticket)
+
+    def _drop(self, ticket):
+        ticket.released = True
+        self.users.discard(ticket.username)
+        if ticket.running:
+            self.running -= 1
+        else:
+            self.queued -= 1
+        self.condition.notify_all()
+
+    def acquire(self, username):
+        ticket = self.reserve(username)
+        ticket.wait()
+        return ticket
+
+    @contextmanager
+    def admit(self, username):
+        ticket = self.acquire(username)
+        try:
+            yield ticket
+        finally:
+            ticket.release()
+
+    def stats(self):
+        with self.condition:
+            stats = dict(self.counters, running=self.running, queued=self.queued)
+            stats['average_duration'] = round(self.average_duration, 3)
+        return stats
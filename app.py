@@ -1,15 +1,143 @@
 import os
+import json
+import time
 import logging
-from flask import Flask, redirect, request, session, render_template
+import threading
+from functools import partial
+from flask import Flask, Response, redirect, request, session, render_template, jsonify, stream_with_context
 from last_fm_auth import get_lastfm_api_key
-from last_fm_data_service import get_user_top_tracks
-from recommendation_service import generate_recommendations
+from history import ingest_profile, HISTORY_SEED_TRACKS
+from profile_store import ProfileStore
+import startup
+import metrics
+from result_cache import ResultCache
+from jobs import JobManager
+from admission import AdmissionController, Rejected
+from track_model import pinned
+import track_cache
+from track_tag_cache import TrackTagCache
 
 app = Flask(__name__)
 app.secret_key = os.getenv("FLASK_SECRET_KEY", os.urandom(24))
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
+admission = AdmissionController()
+result_cache = ResultCache(admission=admission)
+profile_store = ProfileStore()
+
+RECOMMENDATION_JOBS = os.getenv("RECOMMENDATION_JOBS", "1") == "1"
+RECOMMENDATION_STREAMING = os.getenv("RECOMMENDATION_STREAMING", "0") == "1"
+USER_PROFILES = os.getenv("USER_PROFILES", "1") == "1"
+CACHE_PURGE_INTERVAL = int(os.getenv("CACHE_PURGE_INTERVAL", str(6 * 60 * 60)))
+
+metrics.register_collector(metrics.stats_collector('lastfm_result_cache', result_cache.stats, "Recommendation result cache"))
+metrics.register_collector(metrics.stats_collector('lastfm_profiles', profile_store.stats, "Stored user profiles"))
+metrics.register_collector(metrics.stats_collector('lastfm_admission', admission.stats, "Recommendation admission control"))
+
+def load_profile(username):
+    service = startup.load_recommendation_service()
+    with metrics.stage('history'):
+        if USER_PROFILES:
+            return profile_store.sync(username, service.get_track_tags_many)
+        return ingest_profile(username, service.get_track_tags_many)
+
+def build_recommendations(username, progress=None):
+    with metrics.trace('recommendations') as trace, pinned():
+        try:
+            return compute_recommendations(username, progress)
+        finally:
+            logger.info(f"Recommendations for {username}: {trace.summary()}")
+
+def compute_recommendations(username, progress=None):
+    logger.info(f"Fetching listening history for user {username}...")
+    if progress is not None:
+        progress('history')
+    profile = load_profile(username)
+    top_tracks = profile.top_tracks(HISTORY_SEED_TRACKS)
+
+    if not top_tracks:
+        logger.error(f"No top tracks found for user {username}")
+        return {'tracks': [],
+                'error': f"Unable to retrieve listening history for {username}. Please check the username and try again."}
+
+    logger.info(f"Found {len(top_tracks)} top tracks")
+
+    logger.info("Generating recommendations using machine learning...")
+    service = startup.load_recommendation_service()
+    recommended_tracks, message = result_cache.get_or_compute(
+        username, top_tracks, partial(service.generate_recommendations, progress=progress, profile=profile),
+        refresh=partial(service.generate_recommendations, profile=profile))
+    return {'tracks': recommended_tracks, 'message': message}
+
+def cached_recommendations(username):
+    # With stored profiles, a fresh result for the profile as last synced
+    # can be shown without starting a job.
+    if not USER_PROFILES:
+        return None
+    try:
+        profile, _ = profile_store.load(username)
+    except Exception as e:
+        logger.error(f"Error loading profile for {username}: {e}")
+        return None
+    top_tracks = profile.top_tracks(HISTORY_SEED_TRACKS) if profile is not None else []
+    cached = result_cache.fresh(username, top_tracks) if top_tracks else None
+    if cached is None:
+        return None
+    tracks, message = cached
+    return {'tracks': tracks, 'message': message}
+
+job_manager = JobManager(build_recommendations, admission=admission)
+
+BUSY_MESSAGES = {
+    429: "Your recommendations are already being generated. Please wait a moment and try again.",
+    503: "We're generating a lot of recommendations right now. Please try again in a few seconds."
+}
+
+def rejected_response(rejection, body):
+    logger.warning(f"Rejected recommendation request: {rejection}")
+    return body, rejection.status, {'Retry-After': str(rejection.retry_after)}
+
+def cache_purges():
+    # Purging only touches the database, so the track tag cache is purged
+    # through its own instance rather than by importing the pipeline.
+    return [
+        ('tag tracks', track_cache.purge_expired),
+        ('track tags', TrackTagCache().purge_expired),
+        ('results', result_cache.purge_expired),
+        ('profiles', profile_store.purge_expired),
+    ]
+
+def purge_caches():
+    purged = {}
+    for name, purge in cache_purges():
+        try:
+            purged[name] = purge()
+        except Exception as e:
+            logger.error(f"Error purging expired {name}: {e}")
+    logger.info(f"Purged expired cache entries: {purged}")
+    return purged
+
+_next_purge = 0.0
+_purge_lock = threading.Lock()
+
+@app.before_request
+def schedule_cache_purge():
+    # Expired rows are only skipped on read, so each worker clears them out
+    # in the background on its first request and then every
+    # CACHE_PURGE_INTERVAL seconds; 0 turns this off.
+    global _next_purge
+    if CACHE_PURGE_INTERVAL <= 0:
+        return
+    with _purge_lock:
+        now = time.monotonic()
+        if now < _next_purge:
+            return
+        _next_purge = now + CACHE_PURGE_INTERVAL
+    threading.Thread(target=purge_caches, name="cache-purge", daemon=True).start()
+
+if startup.PRELOAD_APP:
+    startup.warm_up()
 
 @app.route('/')
 def home():
@@ -33,29 +161,112 @@ def recommendations():
         return redirect('/login')
     
     try:
-        logger.info(f"Fetching top tracks for user {username} from the last month...")
-        top_tracks = get_user_top_tracks(username, period='1month', limit=30)
-        
-        if not top_tracks:
-            logger.error(f"No top tracks found for user {username}")
-            return render_template('recommendations.html', 
-                                  tracks=[], 
-                                  error=f"Unable to retrieve listening history for {username}. Please check the username and try again.")
-        
-        logger.info(f"Found {len(top_tracks)} top tracks")
-        
-        logger.info("Generating recommendations using machine learning...")
-        recommended_tracks, message = generate_recommendations(top_tracks)
-        
-        return render_template('recommendations.html', 
-                              tracks=recommended_tracks,
-                              message=message)
+        if RECOMMENDATION_STREAMING or request.args.get('stream') == '1':
+            return render_template('recommendations.html', tracks=[], stream=True)
+
+        if RECOMMENDATION_JOBS:
+            job_id = request.args.get('job')
+            job = job_manager.get(job_id) if job_id else None
+            if job is None or job['username'] != username.lower():
+                cached = cached_recommendations(username)
+                if cached is not None:
+                    return render_template('recommendations.html', **cached)
+                job_id = job_manager.submit(username)
+                return render_template('recommendations.html', tracks=[], job_id=job_id, stage='queued')
+            if job['status'] == 'done':
+                return render_template('recommendations.html', **job['result'])
+            if job['status'] == 'failed':
+                if job['rejected_status']:
+                    raise Rejected(job['error'], job['rejected_status'], job['retry_after'])
+                raise RuntimeError(job['error'])
+            return render_template('recommendations.html', tracks=[], job_id=job_id, stage=job['stage'])
+
+        with admission.admit(username):
+            return render_template('recommendations.html', **build_recommendations(username))
+    except Rejected as e:
+        return rejected_response(e, render_template('recommendations.html', tracks=[], error=BUSY_MESSAGES[e.status]))
     except Exception as e:
         logger.error(f"Error generating recommendations: {str(e)}")
         return render_template('recommendations.html', 
                               tracks=[], 
                               error="An error occurred while generating recommendations. Please try again later.")
 
+@app.route('/recommendations/status/<job_id>')
+def recommendation_status(job_id):
+    username = session.get('username')
+    job = job_manager.get(job_id)
+    if not username or job is None or job['username'] != username.lower():
+        return jsonify({'error': 'Job not found'}), 404
+    body = jsonify({
+        'id': job['id'],
+        'status': job['status'],
+        'stage': job['stage'],
+        'error': job['error'],
+        'retry_after': job['retry_after'],
+        'result': job['result'] if job['status'] == 'done' else None
+    })
+    if job['rejected_status']:
+        return rejected_response(Rejected(job['error'], job['rejected_status'], job['retry_after']), body)
+    return body
+
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+@app.route('/recommendations/stream')
+def recommendations_stream():
+    username = session.get('username')
+    if not username:
+        return jsonify({'error': 'Not logged in'}), 401
+
+    # The slot is taken before the response starts so a rejection can still
+    # be sent as a status code, and given back when the stream finishes or
+    # the response is closed without ever being read.
+    try:
+        ticket = admission.acquire(username)
+    except Rejected as e:
+        return rejected_response(e, jsonify({'error': BUSY_MESSAGES[e.status]}))
+
+    def events():
+        with metrics.trace('stream') as trace, pinned():
+            try:
+                yield from recommendation_events()
+            finally:
+                ticket.release()
+                logger.info(f"Streamed recommendations for {username}: {trace.summary()}")
+
+    def recommendation_events():
+        try:
+            yield sse_event('stage', 'history')
+            profile = load_profile(username)
+            top_tracks = profile.top_tracks(HISTORY_SEED_TRACKS)
+            if not top_tracks:
+                yield sse_event('error', f"Unable to retrieve listening history for {username}. Please check the username and try again.")
+                return
+
+            service = startup.load_recommendation_service()
+            cached = result_cache.lookup(username, top_tracks, partial(service.generate_recommendations, profile=profile))
+            if cached is not None:
+                tracks, message = cached
+                yield sse_event('ranking', {'tracks': tracks, 'message': message})
+            else:
+                for event, data in service.stream_recommendations(top_tracks, profile):
+                    if event == 'ranking':
+                        result_cache.store(username, top_tracks, (data['tracks'], data['message']))
+                    yield sse_event(event, data)
+            yield sse_event('done', {})
+        except Exception as e:
+            logger.error(f"Error streaming recommendations: {str(e)}")
+            yield sse_event('error', "An error occurred while generating recommendations. Please try again later.")
+
+    response = Response(stream_with_context(events()), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    response.call_on_close(ticket.release)
+    return response
+
+@app.route('/metrics')
+def metrics_endpoint():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
 @app.route('/logout')
 def logout():
     session.clear()
@@ -0,0 +1,152 @@
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+from multiprocessing import Pool
+import metrics
+import startup
+from history import ingest_profile, HISTORY_SEED_TRACKS
+from profile_store import ProfileStore
+from track_model import pinned
+
+logger = logging.getLogger(__name__)
+
+BATCH_WORKERS = int(os.getenv("BATCH_WORKERS", str(os.cpu_count() or 2)))
+BATCH_REPORT_EVERY = 50
+
+_profile_store = None
+
+def read_usernames(lines):
+    seen = set()
+    for line in lines:
+        username = line.strip()
+        if username and not username.startswith('#') and username.lower() not in seen:
+            seen.add(username.lower())
+            yield username
+
+def read_done(path, retry_failed=True):
+    done = set()
+    if not os.path.exists(path):
+        return done
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if record.get('error') and retry_failed:
+                continue
+            done.add(record.get('username', '').lower())
+    return done
+
+def open_output(path):
+    # An interrupted run can leave half a line behind; start on a fresh one
+    # so the next record is still valid JSON.
+    needs_newline = False
+    if os.path.exists(path) and os.path.getsize(path):
+        with open(path, 'rb') as f:
+            f.seek(-1, os.SEEK_END)
+            needs_newline = f.read(1) != b'\n'
+    output = open(path, 'a', encoding='utf-8')
+    if needs_newline:
+        output.write('\n')
+    return output
+
+def init_worker(workers, use_profiles):
+    from last_fm_data_service import configure_client, LASTFM_RATE_LIMIT, LASTFM_RATE_BURST
+    global _profile_store
+    # The rate limit is per API key, so the workers split it between them.
+    configure_client(rate_limit=LASTFM_RATE_LIMIT / workers, burst=max(1, LASTFM_RATE_BURST // workers))
+    _profile_store = ProfileStore() if use_profiles else None
+    startup.load_recommendation_service()
+
+def recommend_user(username):
+    service = startup.load_recommendation_service()
+    start = time.perf_counter()
+    with metrics.trace('batch') as trace, pinned():
+        try:
+            if _profile_store is not None:
+                profile = _profile_store.sync(username, service.get_track_tags_many)
+            else:
+                profile = ingest_profile(username, service.get_track_tags_many)
+            top_tracks = profile.top_tracks(HISTORY_SEED_TRACKS)
+            if top_tracks:
+                tracks, message = service.generate_recommendations(top_tracks, profile=profile)
+                record = {'username': username, 'tracks': tracks, 'message': message}
+            else:
+                record = {'username': username, 'tracks': [], 'error': "No listening history found"}
+        except Exception as e:
+            logger.error(f"Error generating recommendations for {username}: {e}")
+            record = {'username': username, 'tracks': [], 'error': str(e)}
+        api_calls = sum(value for name, value in trace.counts.items() if name.startswith('api.'))
+    record['api_calls'] = api_calls
+    record['elapsed'] = round(time.perf_counter() - start, 3)
+    record['finished_at'] = time.time()
+    return record
+
+def report(started, processed, failed, api_calls):
+    elapsed = time.perf_counter() - started
+    return {
+        'users': processed,
+        'failed': failed,
+        'elapsed_seconds': round(elapsed, 1),
+        'users_per_minute': round(processed / elapsed * 60, 1) if elapsed else 0.0,
+        'api_calls_per_user': round(api_calls / processed, 1) if processed else 0.0
+    }
+
+def run_batch(usernames, output_path, workers=BATCH_WORKERS, use_profiles=True, retry_failed=True):
+    done = read_done(output_path, retry_failed)
+    pending_users = (username for username in usernames if username.lower() not in done)
+    if done:
+        logger.info(f"Skipping {len(done)} users already in {output_path}")
+
+    started = time.perf_counter()
+    processed = failed = api_calls = 0
+    # Results come back in completion order and are written straight away,
+    # so nothing accumulates in memory. Leaving the block terminates the
+    # workers, and users that were still running are picked up on resume.
+    with open_output(output_path) as output, \
+            Pool(workers, initializer=init_worker, initargs=(workers, use_profiles)) as pool:
+        try:
+            for record in pool.imap_unordered(recommend_user, pending_users):
+                output.write(json.dumps(record) + '\n')
+                output.flush()
+                processed += 1
+                failed += 1 if record.get('error') else 0
+                api_calls += record['api_calls']
+                if processed % BATCH_REPORT_EVERY == 0:
+                    logger.info(f"Batch progress: {report(started, processed, failed, api_calls)}")
+        except KeyboardInterrupt:
+            logger.warning(f"Interrupted after {processed} users; rerun with the same output to resume")
+            raise
+    return report(started, processed, failed, api_calls)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate recommendations for many Last.fm users into a JSONL file.")
+    parser.add_argument('input', help="file with one username per line, or - for stdin")
+    parser.add_argument('-o', '--output', required=True, help="JSONL file to append results to; reused to resume")
+    parser.add_argument('-w', '--workers', type=int, default=BATCH_WORKERS)
+    parser.add_argument('--no-profiles', action='store_true', help="rebuild profiles instead of using stored ones")
+    parser.add_argument('--skip-failed', action='store_true', help="do not retry users that failed in an earlier run")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(processName)s %(levelname)s %(name)s: %(message)s")
+    for name in ('recommendation_service', 'track_cache', 'last_fm_data_service', 'history'):
+        logging.getLogger(name).setLevel(logging.WARNING)
+
+    lines = sys.stdin if args.input == '-' else open(args.input, 'r', encoding='utf-8')
+    try:
+        summary = run_batch(read_usernames(lines), args.output, max(1, args.workers),
+                            not args.no_profiles, not args.skip_failed)
+    except KeyboardInterrupt:
+        return 130
+    finally:
+        if lines is not sys.stdin:
+            lines.close()
+    print(json.dumps(summary, indent=2))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,197 @@
+import sys
+import json
+import time
+import random
+import hashlib
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+N_TAGS = 200
+N_ARTISTS = 400
+SONGS_PER_ARTIST = 50
+RECENT_DISTINCT_TRACKS = 2000
+RECENT_EPOCH = 1700000000
+
+def stable_hash(*parts):
+    return int(hashlib.md5("|".join(str(part) for part in parts).lower().encode('utf-8')).hexdigest(), 16)
+
+class FakeLastFm:
+    def __init__(self, latency_ms=0.0, jitter_ms=0.0, error_rate=0.0, seed=0):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.errors = 0
+
+    def reset_counters(self):
+        with self.lock:
+            self.calls = {}
+            self.errors = 0
+
+    def counters(self):
+        with self.lock:
+            return {'calls': dict(self.calls), 'total_calls': sum(self.calls.values()), 'errors': self.errors}
+
+    def track(self, artist_id, song_id):
+        artist = f"Artist {artist_id}"
+        name = f"Song {song_id}"
+        return {
+            'name': name,
+            'playcount': str(stable_hash(artist, name, 'plays') % 100000),
+            'listeners': str(stable_hash(artist, name, 'listeners') % 50000),
+            'mbid': '',
+            'url': f"https://www.last.fm/music/{artist.replace(' ', '+')}/_/{name.replace(' ', '+')}",
+            'artist': {'name': artist, 'mbid': '', 'url': ''},
+            'image': [{'#text': '', 'size': size} for size in ('small', 'medium', 'large')]
+        }
+
+    def track_ids(self, artist, name):
+        try:
+            return int(artist.split()[-1]), int(name.split()[-1])
+        except (ValueError, IndexError):
+            return stable_hash(artist) % N_ARTISTS, stable_hash(name) % SONGS_PER_ARTIST
+
+    def track_tags(self, artist, name):
+        artist_id, song_id = self.track_ids(artist, name)
+        rng = random.Random(stable_hash(artist_id, song_id))
+        # Tracks by the same artist share a neighbourhood of tags, which
+        # gives the similarity stages real structure to find.
+        base = (artist_id * 7) % N_TAGS
+        tags = {f"tag {(base + rng.randint(0, 12)) % N_TAGS}" for _ in range(rng.randint(0, 10))}
+        return [{'name': tag, 'count': rng.randint(1, 100), 'url': ''} for tag in sorted(tags)]
+
+    def tag_tracks(self, tag, limit):
+        rng = random.Random(stable_hash('tag', tag))
+        return [self.track(rng.randrange(N_ARTISTS), rng.randrange(SONGS_PER_ARTIST)) for _ in range(limit)]
+
+    def user_tracks(self, user, count):
+        rng = random.Random(stable_hash('user', user))
+        favourite_artists = [rng.randrange(N_ARTISTS) for _ in range(max(1, count // 5))]
+        tracks, seen = [], set()
+        while len(tracks) < count:
+            ids = (rng.choice(favourite_artists), rng.randrange(SONGS_PER_ARTIST))
+            if ids not in seen:
+                seen.add(ids)
+                tracks.append(ids)
+        return tracks
+
+    def respond(self, params):
+        method = params.get('method', '').lower()
+        with self.lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+        limit = int(params.get('limit', 50))
+        page = int(params.get('page', 1))
+
+        if method == 'user.gettoptracks':
+            history = int(params.get('user', '').rsplit('-', 1)[-1]) if params.get('user', '').rsplit('-', 1)[-1].isdigit() else 200
+            ids = self.user_tracks(params.get('user', ''), history)
+            page_ids = ids[(page - 1) * limit:page * limit]
+            tracks = []
+            for rank, (artist_id, song_id) in enumerate(page_ids):
+                track = self.track(artist_id, song_id)
+                track['playcount'] = str(max(1, 500 - (page - 1) * limit - rank))
+                tracks.append(track)
+            total_pages = max(1, -(-len(ids) // limit))
+            return {'toptracks': {'track': tracks, '@attr': {'user': params.get('user'), 'page': str(page), 'perPage': str(limit), 'totalPages': str(total_pages), 'total': str(len(ids))}}}
+        if method == 'user.getrecenttracks':
+            # Scrobbles are drawn from a smaller set of distinct tracks with a
+            # skewed distribution, and only the requested page is generated,
+            # so 100k-play histories stay cheap to serve.
+            user = params.get('user', '')
+            history = int(user.rsplit('-', 1)[-1]) if user.rsplit('-', 1)[-1].isdigit() else 200
+            ids = self.user_tracks(user, min(history, RECENT_DISTINCT_TRACKS))
+            newest = RECENT_EPOCH + history * 600
+            since = int(params.get('from', 0))
+            available = history if since <= RECENT_EPOCH else max(0, min(history, (newest - since) // 600 + 1))
+            plays = []
+            for i in range((page - 1) * limit, min(page * limit, available)):
+                rng = random.Random(stable_hash('play', user, i))
+                artist_id, song_id = ids[int(rng.paretovariate(1.2) * 3) % len(ids)]
+                track = self.track(artist_id, song_id)
+                plays.append({'name': track['name'], 'artist': {'#text': track['artist']['name'], 'mbid': ''}, 'mbid': '', 'url': track['url'], 'date': {'uts': str(newest - i * 600)}})
+            total_pages = max(1, -(-available // limit))
+            return {'recenttracks': {'track': plays, '@attr': {'user': user, 'page': str(page), 'perPage': str(limit), 'totalPages': str(total_pages), 'total': str(available)}}}
+        if method == 'track.gettoptags':
+            tags = self.track_tags(params.get('artist', ''), params.get('track', ''))
+            return {'toptags': {'tag': tags[:limit], '@attr': {'artist': params.get('artist'), 'track': params.get('track')}}}
+        if method == 'tag.gettoptracks':
+            return {'tracks': {'track': self.tag_tracks(params.get('tag', ''), limit), '@attr': {'tag': params.get('tag')}}}
+        if method == 'track.getsimilar':
+            artist_id, song_id = self.track_ids(params.get('artist', ''), params.get('track', ''))
+            rng = random.Random(stable_hash('similar', artist_id, song_id))
+            tracks = []
+            for i in range(limit):
+                track = self.track((artist_id + rng.randint(-3, 3)) % N_ARTISTS, rng.randrange(SONGS_PER_ARTIST))
+                track['match'] = round(1 - i / max(limit, 1), 3)
+                tracks.append(track)
+            return {'similartracks': {'track': tracks}}
+        if method == 'chart.gettoptags':
+            return {'tags': {'tag': [{'name': f"tag {i}", 'reach': str(N_TAGS - i), 'taggings': str(1000 - i)} for i in range(min(limit, N_TAGS))]}}
+        return {'error': 3, 'message': 'Invalid Method - No method with that name in this package'}
+
+    def handle(self, params):
+        delay = self.latency_ms + (self.random.uniform(-self.jitter_ms, self.jitter_ms) if self.jitter_ms else 0)
+        if delay > 0:
+            time.sleep(delay / 1000.0)
+        if self.error_rate and self.random.random() < self.error_rate:
+            with self.lock:
+                self.errors += 1
+            if self.random.random() < 0.5:
+                return 503, {'error': 16, 'message': 'There was a temporary error processing your request.'}
+            return 200, {'error': 29, 'message': 'Rate limit exceeded'}
+        return 200, self.respond(params)
+
+def make_handler(fake):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        # Headers and body go out as separate writes on a kept-alive
+        # connection; with Nagle on, the body waits for the client's delayed
+        # ACK and every response gains about 40ms.
+        disable_nagle_algorithm = True
+
+        def do_GET(self):
+            params = {name: values[0] for name, values in parse_qs(urlparse(self.path).query).items()}
+            status, payload = fake.handle(params)
+            body = json.dumps(payload).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+def start_server(fake, host='127.0.0.1', port=0):
+    server = ThreadingHTTPServer((host, port), make_handler(fake))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}/2.0/"
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve a deterministic local stand-in for the Last.fm API.")
+    parser.add_argument('--port', type=int, default=8901)
+    parser.add_argument('--latency-ms', type=float, default=0.0)
+    parser.add_argument('--jitter-ms', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+    fake = FakeLastFm(args.latency_ms, args.jitter_ms, args.error_rate, args.seed)
+    server, url = start_server(fake, port=args.port)
+    print(f"Fake Last.fm listening at {url} (set LASTFM_API_URL to use it)")
+    try:
+        while True:
+            time.sleep(60)
+            print(json.dumps(fake.counters()))
+    except KeyboardInterrupt:
+        server.shutdown()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,214 @@
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import logging
+import argparse
+import resource
+import tempfile
+import threading
+import importlib
+from concurrent.futures import ThreadPoolExecutor
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARK_DIR)
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, BENCHMARK_DIR)
+
+from fake_lastfm import FakeLastFm, start_server
+
+# Metrics compared against a saved baseline, and whether a larger value is
+# better for each of them.
+COMPARED_METRICS = {
+    'latency_p50_ms': False,
+    'latency_p95_ms': False,
+    'throughput_users_per_s': True,
+    'api_calls_per_user': False,
+    'peak_rss_mb': False
+}
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+class StageRecorder:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.totals = {}
+
+    def track(self):
+        marks = [('start', time.perf_counter())]
+
+        def progress(stage):
+            marks.append((stage, time.perf_counter()))
+
+        def finish():
+            marks.append(('end', time.perf_counter()))
+            with self.lock:
+                for (stage, started), (_, ended) in zip(marks, marks[1:]):
+                    self.totals[stage] = self.totals.get(stage, 0.0) + (ended - started)
+
+        return progress, finish
+
+    def summary(self, runs):
+        with self.lock:
+            return {stage: round(total / max(runs, 1) * 1000, 2) for stage, total in self.totals.items()}
+
+def run_pipeline(usernames, history, concurrency, stages):
+    from last_fm_data_service import get_user_top_tracks
+    from track_model import pinned
+    service = importlib.import_module('recommendation_service')
+
+    def run(username):
+        with pinned():
+            top_tracks = get_user_top_tracks(username, period='1month', limit=history)
+            progress, finish = stages.track()
+            start = time.perf_counter()
+            tracks, _ = service.generate_recommendations(top_tracks, progress=progress)
+            finish()
+        return time.perf_counter() - start, len(tracks)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        return list(executor.map(run, usernames))
+
+def run_route(usernames, concurrency, repeat):
+    app_module = importlib.import_module('app')
+
+    def run(username):
+        client = app_module.app.test_client()
+        with client.session_transaction() as session:
+            session['username'] = username
+        results = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            response = client.get('/recommendations')
+            results.append((time.perf_counter() - start, response.data.count(b'class="track-item"')))
+        return results
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        return [result for results in executor.map(run, usernames) for result in results]
+
+def cache_stats():
+    stats = {}
+    service = sys.modules.get('recommendation_service')
+    if service is not None:
+        stats['tag_cache'] = service.tag_cache.stats()
+    app_module = sys.modules.get('app')
+    if app_module is not None:
+        stats['result_cache'] = app_module.result_cache.stats()
+    from last_fm_data_service import get_client
+    stats['lastfm_client'] = get_client().stats()
+    return stats
+
+def run_benchmark(args):
+    fake = FakeLastFm(args.latency_ms, args.jitter_ms, args.error_rate, args.seed)
+    server, url = start_server(fake)
+    os.environ['LASTFM_API_URL'] = url
+    os.environ.setdefault('LASTFM_API_KEY', 'benchmark')
+    os.environ['LASTFM_RATE_LIMIT'] = str(args.rate_limit)
+    os.environ['RECOMMENDATION_JOBS'] = '0'
+
+    work_dir = tempfile.mkdtemp(prefix='lastfm-bench-')
+    previous_dir = os.getcwd()
+    os.chdir(work_dir)
+    try:
+        if args.candidate_index:
+            import candidate_index
+            candidate_index.build_index(args.index_tags, args.index_tracks_per_tag)
+        fake.reset_counters()
+        random.seed(args.seed)
+        usernames = [f"bench-{i}-{args.history}" for i in range(args.users)]
+        stages = StageRecorder()
+
+        start = time.perf_counter()
+        if args.target == 'pipeline':
+            results = run_pipeline(usernames, args.history, args.concurrency, stages)
+        else:
+            results = run_route(usernames, args.concurrency, args.repeat)
+        wall = time.perf_counter() - start
+
+        latencies = [elapsed for elapsed, _ in results]
+        counters = fake.counters()
+        report = {
+            'config': {name: value for name, value in vars(args).items() if name not in ('save_baseline', 'compare')},
+            'runs': len(results),
+            'wall_s': round(wall, 3),
+            'throughput_users_per_s': round(len(results) / wall, 3) if wall else 0.0,
+            'latency_p50_ms': round(percentile(latencies, 0.5) * 1000, 2),
+            'latency_p95_ms': round(percentile(latencies, 0.95) * 1000, 2),
+            'latency_max_ms': round(max(latencies, default=0) * 1000, 2),
+            'recommendations_per_run': round(sum(count for _, count in results) / max(len(results), 1), 1),
+            'api_calls': counters['calls'],
+            'api_calls_per_user': round(counters['total_calls'] / max(args.users, 1), 1),
+            'api_errors_injected': counters['errors'],
+            'cache': cache_stats(),
+            'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+        }
+        if args.target == 'pipeline':
+            report['stage_ms'] = stages.summary(len(results))
+        return report
+    finally:
+        os.chdir(previous_dir)
+        server.shutdown()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+def compare(report, baseline, tolerance):
+    regressions = []
+    lines = []
+    for metric, higher_is_better in COMPARED_METRICS.items():
+        current, previous = report.get(metric), baseline.get(metric)
+        if current is None or not previous:
+            continue
+        change = (current - previous) / previous
+        regressed = change < -tolerance if higher_is_better else change > tolerance
+        lines.append(f"{metric:<24} {previous:>12} -> {current:<12} {change:+.1%}{'  REGRESSION' if regressed else ''}")
+        if regressed:
+            regressions.append(metric)
+    return lines, regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the recommendation pipeline against a local fake Last.fm API.")
+    parser.add_argument('--target', choices=['pipeline', 'route'], default='pipeline',
+                        help="drive generate_recommendations directly or the Flask /recommendations route")
+    parser.add_argument('--users', type=int, default=10)
+    parser.add_argument('--history', type=int, default=30, help="top tracks fetched per user")
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--repeat', type=int, default=1, help="route visits per user")
+    parser.add_argument('--latency-ms', type=float, default=50.0)
+    parser.add_argument('--jitter-ms', type=float, default=10.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--rate-limit', type=float, default=1000.0, help="client requests per second")
+    parser.add_argument('--candidate-index', action='store_true', help="build a candidate index before running")
+    parser.add_argument('--index-tags', type=int, default=30)
+    parser.add_argument('--index-tracks-per-tag', type=int, default=50)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--save-baseline', metavar='PATH', help="write the report to PATH")
+    parser.add_argument('--compare', metavar='PATH', help="compare against a saved baseline")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="allowed relative regression")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING)
+    report = run_benchmark(args)
+    print(json.dumps(report, indent=2))
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+        print(f"Saved baseline to {args.save_baseline}")
+
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        lines, regressions = compare(report, baseline, args.tolerance)
+        print("\n".join(lines))
+        if regressions:
+            print(f"Regressions beyond {args.tolerance:.0%}: {', '.join(regressions)}")
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,206 @@
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import numpy as np
+from scipy import sparse
+from last_fm_data_service import get_top_tags, fetch_tracks_by_tag
+from tag_similarity import TagSimilarityEngine, select_top_k
+from track_cache import CACHE_DIR, get_tracks_for_tags
+from track_model import Track
+from versioned_dir import VersionedLoader, read_current, new_version, write_current, prune_versions, directory_size
+
+logger = logging.getLogger(__name__)
+
+CANDIDATE_INDEX_DIR = os.getenv("CANDIDATE_INDEX_DIR", os.path.join(CACHE_DIR, "candidate_index"))
+MATRIX_ARRAYS = ['data', 'indices', 'indptr']
+TRACK_ARRAYS = ['name', 'artist', 'url', 'mbid', 'playcount', 'listeners', 'keys', 'key_rows']
+
+class CandidateIndex:
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "meta.json"), 'r', encoding='utf-8') as f:
+            self.meta = json.load(f)
+        self.vocabulary = {tag: i for i, tag in enumerate(self.meta['vocabulary'])}
+        arrays = {name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode='r')
+                  for name in MATRIX_ARRAYS + TRACK_ARRAYS}
+        self.matrix = sparse.csr_matrix(
+            (arrays['data'], arrays['indices'], arrays['indptr']),
+            shape=(self.meta['n_tracks'], len(self.vocabulary)),
+            copy=False
+        )
+        self.tracks = {name: arrays[name] for name in TRACK_ARRAYS}
+
+    def __len__(self):
+        return self.matrix.shape[0]
+
+    def track(self, row):
+        return Track(
+            str(self.tracks['name'][row]),
+            str(self.tracks['artist'][row]),
+            int(self.tracks['playcount'][row]),
+            int(self.tracks['listeners'][row]),
+            str(self.tracks['mbid'][row]),
+            str(self.tracks['url'][row])
+        )
+
+    def rows_for_keys(self, keys):
+        width = self.tracks['keys'].dtype.itemsize // 4
+        keys = np.asarray(sorted(key for key in keys if len(key) <= width), dtype=self.tracks['keys'].dtype)
+        if not len(keys) or not len(self):
+            return np.array([], dtype=np.int64)
+        positions = np.clip(np.searchsorted(self.tracks['keys'], keys), 0, len(self) - 1)
+        found = self.tracks['keys'][positions] == keys
+        return np.asarray(self.tracks['key_rows'][positions[found]])
+
+    def vectorize(self, tag_lists):
+        return TagSimilarityEngine(self.vocabulary).build_matrix(tag_lists, extend_vocabulary=False, dtype=np.float32)
+
+    def query(self, seed_matrix, k, exclude_rows=()):
+        scores = np.round((seed_matrix @ self.matrix.T).toarray(), 6)
+        scores[:, np.asarray(exclude_rows, dtype=np.int64)] = -np.inf
+        return select_top_k(scores, k, np.diff(seed_matrix.indptr) > 0)
+
+def load_index(path):
+    index = CandidateIndex(path)
+    logger.info(f"Loaded candidate index {os.path.basename(path)} with {len(index)} tracks")
+    return index
+
+_loader = VersionedLoader(CANDIDATE_INDEX_DIR, load_index, "candidate index")
+
+def get_candidate_index():
+    return _loader.get()
+
+def crawl_candidates(n_tags, tracks_per_tag):
+    from recommendation_service import get_track_tags_many
+
+    tags = [tag.get('name', '').lower() for tag in get_top_tags(limit=n_tags)]
+    tags = [tag for tag in tags if tag]
+    logger.info(f"Crawling {len(tags)} tags")
+    # The crawl always refetches: the request path caches short lists for a
+    # week, and an index build should reflect what Last.fm lists today.
+    tracks_by_tag = get_tracks_for_tags(tags, fetch_tracks_by_tag, limit=tracks_per_tag, force_refresh=True)
+    tracks = {}
+    for tag in tags:
+        for track in tracks_by_tag[tag]:
+            tracks.setdefault(track.id, track)
+    logger.info(f"Fetching tags for {len(tracks)} candidate tracks")
+    return tags, list(tracks.values()), get_track_tags_many(tracks.values())
+
+def write_index(tracks, track_tags, index_dir, info):
+    rows, tag_lists = [], []
+    for track in tracks:
+        tags = track_tags.get(track.id)
+        if tags:
+            rows.append(track)
+            tag_lists.append(tags)
+    engine = TagSimilarityEngine()
+    matrix = engine.build_matrix(tag_lists, dtype=np.float32)
+    keys = np.array([track.key for track in rows])
+    key_rows = np.argsort(keys, kind='stable')
+    arrays = {
+        'data': matrix.data,
+        'indices': matrix.indices.astype(np.int32),
+        'indptr': matrix.indptr.astype(np.int32),
+        'name': np.array([track.name for track in rows]),
+        'artist': np.array([track.artist for track in rows]),
+        'url': np.array([track.url for track in rows]),
+        'mbid': np.array([track.mbid for track in rows]),
+        'playcount': np.array([track.playcount for track in rows], dtype=np.int64),
+        'listeners': np.array([track.listeners for track in rows], dtype=np.int64),
+        'keys': keys[key_rows],
+        'key_rows': key_rows
+    }
+
+    version, path = new_version(index_dir)
+    for name, array in arrays.items():
+        np.save(os.path.join(path, f"{name}.npy"), array)
+    meta = dict(info, n_tracks=len(rows), vocabulary=sorted(engine.vocabulary, key=engine.vocabulary.get))
+    with open(os.path.join(path, "meta.json"), 'w', encoding='utf-8') as f:
+        json.dump(meta, f)
+    write_current(index_dir, version)
+    return path
+
+def measure_query_latency(index, n_queries=50, seeds_per_query=30, k=5):
+    if not len(index):
+        return []
+    rng = np.random.default_rng(0)
+    latencies = []
+    for _ in range(n_queries):
+        seed_rows = rng.choice(len(index), size=min(seeds_per_query, len(index)), replace=False)
+        start = time.perf_counter()
+        index.query(index.matrix[seed_rows], k, seed_rows)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+def build_index(n_tags=50, tracks_per_tag=100, index_dir=CANDIDATE_INDEX_DIR):
+    start = time.perf_counter()
+    tags, tracks, track_tags = crawl_candidates(n_tags, tracks_per_tag)
+    crawl_seconds = time.perf_counter() - start
+    path = write_index(tracks, track_tags, index_dir, {
+        'built_at': time.time(),
+        'source_tags': tags,
+        'tracks_per_tag': tracks_per_tag,
+        'crawl_seconds': crawl_seconds
+    })
+    build_seconds = time.perf_counter() - start
+    prune_versions(index_dir)
+
+    index = CandidateIndex(path)
+    latencies = sorted(measure_query_latency(index))
+    report = {
+        'path': path,
+        'tags': len(tags),
+        'tracks': len(index),
+        'vocabulary': len(index.vocabulary),
+        'crawl_seconds': round(crawl_seconds, 2),
+        'build_seconds': round(build_seconds, 2),
+        'size_bytes': directory_size(path)
+    }
+    if latencies:
+        report['query_p50_ms'] = round(latencies[len(latencies) // 2] * 1000, 2)
+        report['query_p95_ms'] = round(latencies[int(len(latencies) * 0.95)] * 1000, 2)
+    return report
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build or inspect the offline candidate index.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    build = subparsers.add_parser('build', help="Crawl the top Last.fm tags and write a new index")
+    build.add_argument('--tags', type=int, default=50, help="number of top tags to crawl")
+    build.add_argument('--tracks-per-tag', type=int, default=100, help="tracks fetched per tag")
+    build.add_argument('--index-dir', default=CANDIDATE_INDEX_DIR)
+    stats = subparsers.add_parser('stats', help="Report size and query latency of the current index")
+    stats.add_argument('--index-dir', default=CANDIDATE_INDEX_DIR)
+    args = parser.parse_args(argv)
+
+    if args.command == 'build':
+        report = build_index(args.tags, args.tracks_per_tag, args.index_dir)
+    else:
+        version = read_current(args.index_dir)
+        if version is None:
+            print(f"No candidate index in {args.index_dir}", file=sys.stderr)
+            return 1
+        path = os.path.join(args.index_dir, version)
+        start = time.perf_counter()
+        index = CandidateIndex(path)
+        load_seconds = time.perf_counter() - start
+        latencies = sorted(measure_query_latency(index))
+        report = {
+            'path': path,
+            'tracks': len(index),
+            'vocabulary': len(index.vocabulary),
+            'built_at': time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(index.meta['built_at'])),
+            'size_bytes': directory_size(path),
+            'load_ms': round(load_seconds * 1000, 2)
+        }
+        if latencies:
+            report['query_p50_ms'] = round(latencies[len(latencies) // 2] * 1000, 2)
+            report['query_p95_ms'] = round(latencies[int(len(latencies) * 0.95)] * 1000, 2)
+    print(json.dumps(report, indent=2))
+    return 0
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(main())
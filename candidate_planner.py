@@ -0,0 +1,185 @@
+import os
+import math
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor
+import metrics
+from last_fm_data_service import fetch_tracks_by_tag, fetch_similar_tracks
+from track_cache import get_many as get_tag_tracks, get_tracks_for_tags, get_similar_for_tracks, load_lists, SIMILAR_TRACKS
+
+logger = logging.getLogger(__name__)
+
+# A budget of 0 means no limit on that dimension.
+CANDIDATE_BUDGET_CALLS = int(os.getenv("CANDIDATE_BUDGET_CALLS", "120"))
+CANDIDATE_BUDGET_MS = int(os.getenv("CANDIDATE_BUDGET_MS", "6000"))
+CANDIDATE_MAX_TAGS = int(os.getenv("CANDIDATE_MAX_TAGS", "10"))
+CANDIDATE_MAX_SEEDS = int(os.getenv("CANDIDATE_MAX_SEEDS", "10"))
+CANDIDATE_TRACKS_PER_TAG = int(os.getenv("CANDIDATE_TRACKS_PER_TAG", "20"))
+CANDIDATE_SIMILAR_PER_SEED = int(os.getenv("CANDIDATE_SIMILAR_PER_SEED", "10"))
+CANDIDATE_SIMILAR_WEIGHT = float(os.getenv("CANDIDATE_SIMILAR_WEIGHT", "1.0"))
+CANDIDATE_EXPANSION_CONCURRENCY = 4
+
+class Budget:
+    def __init__(self, calls=CANDIDATE_BUDGET_CALLS, milliseconds=CANDIDATE_BUDGET_MS):
+        self.calls = calls or None
+        self.milliseconds = milliseconds
+        self.started = time.monotonic()
+        self.deadline = self.started + milliseconds / 1000.0 if milliseconds else None
+        self.spent = 0
+
+    def spend(self, calls=1):
+        self.spent += calls
+
+    def calls_left(self):
+        return math.inf if self.calls is None else max(0, self.calls - self.spent)
+
+    def expired(self):
+        return self.deadline is not None and time.monotonic() >= self.deadline
+
+    def elapsed_ms(self):
+        return (time.monotonic() - self.started) * 1000
+
+class Expansion:
+    __slots__ = ('kind', 'target', 'value', 'cost')
+
+    def __init__(self, kind, target, value, cost):
+        self.kind = kind
+        self.target = target
+        self.value = value
+        self.cost = cost
+
+    def priority(self):
+        # Expected value per API call; expansions served from the cache
+        # still cost tag lookups for their tracks, so they are not free.
+        return self.value / (1 + self.cost)
+
+class CandidatePlanner:
+    # Chooses which tag.getTopTracks and track.getsimilar expansions to run
+    # for a request and which candidates to look up tags for, within a
+    # budget of API calls and time. Expansions run best first, in small
+    # batches, until the tag lookups their candidates will need use up
+    # the budget. The lookups then run in order of candidate value until
+    # the budget or the deadline runs out, and whatever has been found by
+    # then is the candidate pool.
+    def __init__(self, seeds, tag_weights, known_ids, budget, cached_tags, fetch_tags,
+                 tracks_per_tag=CANDIDATE_TRACKS_PER_TAG, similar_per_seed=CANDIDATE_SIMILAR_PER_SEED,
+                 similar_weight=CANDIDATE_SIMILAR_WEIGHT, max_workers=CANDIDATE_EXPANSION_CONCURRENCY):
+        self.seeds = seeds
+        self.tag_weights = tag_weights
+        self.known_ids = known_ids
+        self.budget = budget
+        self.cached_tags = cached_tags
+        self.fetch_tags = fetch_tags
+        self.tracks_per_tag = tracks_per_tag
+        self.similar_per_seed = similar_per_seed
+        self.similar_weight = similar_weight
+        self.max_workers = max(1, max_workers)
+        self.tag_tracks = {}
+        self.candidates = {}
+        self.values = {}
+        self.track_tags = {}
+        self.missing = []
+        self.expanded = {'tag': 0, 'similar': 0}
+        self.looked_up = 0
+
+    def options(self):
+        self.tag_tracks = get_tag_tracks([tag for tag, _ in self.tag_weights], self.tracks_per_tag)
+        options = []
+        total = sum(weight for _, weight in self.tag_weights)
+        for tag, weight in self.tag_weights:
+            if weight > 0:
+                options.append(Expansion('tag', tag, weight / total, 0 if tag in self.tag_tracks else 1))
+        cached_similar = load_lists(SIMILAR_TRACKS, [seed.key for seed in self.seeds], self.similar_per_seed)
+        seed_weights = [1 + math.log1p(seed.playcount) for seed in self.seeds]
+        total = sum(seed_weights)
+        for seed, weight in zip(self.seeds, seed_weights):
+            options.append(Expansion('similar', seed, self.similar_weight * weight / total,
+                                     0 if seed.key in cached_similar else 1))
+        return sorted(options, key=Expansion.priority, reverse=True)
+
+    def expand(self):
+        pending = self.options()
+        while pending and not self.budget.expired():
+            # Calls already promised to tag lookups are not available for
+            # further expansions.
+            calls_left = max(0, self.budget.calls_left() - len(self.missing))
+            batch, cost = [], 0
+            for option in pending:
+                if len(batch) == self.max_workers:
+                    break
+                if cost + option.cost <= calls_left:
+                    batch.append(option)
+                    cost += option.cost
+            if not batch:
+                break
+            pending = [option for option in pending if option not in batch]
+            for option, tracks in zip(batch, self.run_expansions(batch)):
+                self.add_candidates(option, tracks)
+                self.expanded[option.kind] += 1
+            self.budget.spend(cost)
+        metrics.count("planner.tag_expansions", self.expanded['tag'])
+        metrics.count("planner.similar_expansions", self.expanded['similar'])
+        return sorted(self.candidates.values(), key=lambda track: self.values[track.id], reverse=True)
+
+    def run_expansions(self, batch):
+        # Both kinds go through the track list cache, which keeps whatever
+        # comes back, and no retry is started past the budget's deadline.
+        deadline = self.budget.deadline
+        tags = [option.target for option in batch if option.kind == 'tag' and option.cost]
+        similar = [option.target for option in batch if option.kind == 'similar']
+        fetch_tags = lambda tag, limit: fetch_tracks_by_tag(tag, limit, deadline)
+        fetch_similar = lambda artist, name, limit: fetch_similar_tracks(artist, name, limit, deadline)
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            similar_tracks = executor.submit(metrics.bind_trace(get_similar_for_tracks), similar, fetch_similar,
+                                             self.similar_per_seed, self.max_workers)
+            if tags:
+                self.tag_tracks.update(get_tracks_for_tags(tags, fetch_tags, self.tracks_per_tag,
+                                                           max_workers=self.max_workers))
+            similar_tracks = similar_tracks.result()
+        return [self.tag_tracks.get(option.target, []) if option.kind == 'tag' else similar_tracks[option.target.id]
+                for option in batch]
+
+    def add_candidates(self, option, tracks):
+        limit = self.tracks_per_tag if option.kind == 'tag' else self.similar_per_seed
+        tracks = tracks[:limit]
+        new_tracks = []
+        for position, track in enumerate(tracks):
+            if track.id in self.known_ids:
+                continue
+            # Both sources list their best tracks first.
+            value = option.value * (1 - position / (len(tracks) + 1))
+            if track.id in self.values:
+                self.values[track.id] += value
+            else:
+                self.candidates[track.id] = track
+                self.values[track.id] = value
+                new_tracks.append(track)
+        found, missing = self.cached_tags(new_tracks)
+        self.track_tags.update(found)
+        self.missing.extend(missing)
+
+    def iter_tags(self):
+        yield from self.track_tags.items()
+        if self.budget.expired():
+            return
+        missing = sorted(self.missing, key=lambda track: self.values[track.id], reverse=True)
+        calls_left = self.budget.calls_left()
+        if calls_left < len(missing):
+            missing = missing[:int(calls_left)]
+        # Lookups are charged as they start, so calls still running when the
+        # deadline stops the loop count against the budget too.
+        tags = self.fetch_tags(missing, deadline=self.budget.deadline, on_submit=self.budget.spend)
+        try:
+            for track_id, track_tags in tags:
+                self.looked_up += 1
+                yield track_id, track_tags
+                if self.budget.expired():
+                    break
+        finally:
+            tags.close()
+
+    def summary(self):
+        limits = f"{self.budget.calls or 'unlimited'} calls, {self.budget.milliseconds or 'unlimited'} ms"
+        return (f"Candidate plan: {self.expanded['tag']} tag and {self.expanded['similar']} similar-track expansions, "
+                f"{len(self.candidates)} candidates, {len(self.track_tags)} cached and {self.looked_up} fetched tag lookups, "
+                f"{self.budget.spent} API calls in {self.budget.elapsed_ms():.0f}ms (budget {limits})")
@@ -0,0 +1,7 @@
+import os
+
+preload_app = os.getenv("PRELOAD_APP", "0") == "1"
+
+def post_fork(server, worker):
+    import startup
+    startup.after_fork()
@@ -0,0 +1,288 @@
+import os
+import math
+import time
+import heapq
+import logging
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import metrics
+from last_fm_data_service import get_user_top_tracks_page, get_user_recent_tracks_page
+from track_model import Track, intern_key
+
+logger = logging.getLogger(__name__)
+
+HISTORY_SOURCE = os.getenv("HISTORY_SOURCE", "top")
+HISTORY_PERIOD = os.getenv("HISTORY_PERIOD", "1month")
+HISTORY_PAGE_SIZE = int(os.getenv("HISTORY_PAGE_SIZE", "200"))
+HISTORY_MAX_PAGES = int(os.getenv("HISTORY_MAX_PAGES", "5"))
+HISTORY_TIME_BUDGET = float(os.getenv("HISTORY_TIME_BUDGET", "5"))
+HISTORY_FETCH_CONCURRENCY = int(os.getenv("HISTORY_FETCH_CONCURRENCY", "4"))
+HISTORY_PROFILE_TRACKS = int(os.getenv("HISTORY_PROFILE_TRACKS", "100"))
+HISTORY_SEED_TRACKS = int(os.getenv("HISTORY_SEED_TRACKS", "30"))
+HISTORY_KNOWN_TRACKS = int(os.getenv("HISTORY_KNOWN_TRACKS", "5000"))
+# Stored profiles built from scrobbles halve their play counts and tag
+# weights every this many days, standing in for HISTORY_PERIOD's window.
+HISTORY_HALF_LIFE_DAYS = float(os.getenv("HISTORY_HALF_LIFE_DAYS", "15"))
+DAY_SECONDS = 24 * 60 * 60
+
+class HistoryIngester:
+    def __init__(self, username, source=HISTORY_SOURCE, period=HISTORY_PERIOD, page_size=HISTORY_PAGE_SIZE,
+                 max_pages=HISTORY_MAX_PAGES, time_budget=HISTORY_TIME_BUDGET, max_workers=HISTORY_FETCH_CONCURRENCY,
+                 since=None):
+        if source not in ('top', 'recent'):
+            raise ValueError(f"Unknown history source: {source}")
+        self.username = username
+        self.source = source
+        self.period = period
+        self.page_size = page_size
+        self.max_pages = max_pages
+        self.time_budget = time_budget
+        self.max_workers = max_workers
+        self.since = since
+        self.pages = 0
+        self.total_pages = None
+        self.failed_pages = 0
+        self.truncated = False
+        self.latest_timestamp = since
+
+    def fetch_page(self, page):
+        if self.source == 'top':
+            tracks, total_pages = get_user_top_tracks_page(self.username, self.period, page, self.page_size)
+            return [(track, track.playcount, None) for track in tracks], total_pages
+        plays, total_pages = get_user_recent_tracks_page(self.username, page, self.page_size, self.since)
+        return [(track, 1, timestamp) for track, timestamp in plays], total_pages
+
+    def consume(self, entries):
+        for track, plays, timestamp in entries:
+            if timestamp is not None and (self.latest_timestamp is None or timestamp > self.latest_timestamp):
+                self.latest_timestamp = timestamp
+            yield track, plays
+
+    def __iter__(self):
+        deadline = time.monotonic() + self.time_budget if self.time_budget else None
+        entries, self.total_pages = self.fetch_page(1)
+        self.pages = 1
+        yield from self.consume(entries)
+
+        last_page = self.total_pages
+        if self.max_pages:
+            last_page = min(last_page, self.max_pages)
+        if last_page < self.total_pages:
+            self.truncated = True
+        if last_page <= 1:
+            return
+
+        # Only a window of pages is in flight at once, and each page is
+        # handed to the caller as soon as it lands, so memory stays bounded
+        # by the window rather than the length of the history.
+        pages = iter(range(2, last_page + 1))
+        executor = ThreadPoolExecutor(max_workers=max(1, self.max_workers), thread_name_prefix="history")
+        fetch = metrics.bind_trace(self.fetch_page)
+        pending = set()
+        try:
+            for page in pages:
+                pending.add(executor.submit(fetch, page))
+                if len(pending) >= self.max_workers:
+                    break
+            while pending:
+                timeout = None if deadline is None else deadline - time.monotonic()
+                if timeout is not None and timeout <= 0:
+                    logger.warning(f"History time budget of {self.time_budget}s spent after {self.pages} pages for {self.username}")
+                    self.truncated = True
+                    return
+                done, pending = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+                for future in done:
+                    entries, total_pages = future.result()
+                    # The page fetchers report a failed call as 0 pages.
+                    if not total_pages:
+                        self.failed_pages += 1
+                    self.pages += 1
+                    yield from self.consume(entries)
+                    page = next(pages, None)
+                    if page is not None:
+                        pending.add(executor.submit(fetch, page))
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+PROFILE_VERSION = 2
+
+class TagProfile:
+    # `weights` is always the sum, over the tracks in the table, of each
+    # track's tag counts times its level, so a track's share can be taken
+    # out again when it is pruned or its tags change.
+    def __init__(self, max_tracks=HISTORY_PROFILE_TRACKS, max_known=HISTORY_KNOWN_TRACKS):
+        self.max_tracks = max_tracks
+        self.max_known = max_known
+        self.tracks = {}
+        self.plays = {}
+        self.folded = {}
+        self.levels = {}
+        self.tag_counts = {}
+        self.known = {}
+        self.weights = {}
+        self.total_plays = 0
+        self.decayed_at = time.time()
+
+    def add(self, track, plays=1):
+        self.total_plays += plays
+        if track.id in self.plays:
+            self.plays[track.id] += plays
+            return
+        self.tracks[track.id] = track
+        self.plays[track.id] = plays
+        if len(self.plays) > 2 * self.max_tracks:
+            self.prune()
+
+    def prune(self):
+        # Keep the heaviest tracks once the table doubles. A track dropped
+        # here takes its tag weights with it and starts from scratch if it
+        # is seen again, which only matters for tracks never near the top.
+        keep = set(heapq.nlargest(self.max_tracks, self.plays, key=self.plays.__getitem__))
+        for track_id in [track_id for track_id in self.plays if track_id not in keep]:
+            self.apply_weights(track_id, -1)
+            del self.plays[track_id], self.tracks[track_id]
+            self.folded.pop(track_id, None)
+            self.levels.pop(track_id, None)
+            self.tag_counts.pop(track_id, None)
+
+    def apply_weights(self, track_id, sign):
+        level = self.levels.get(track_id, 0.0)
+        for tag_name, count in self.tag_counts.get(track_id, {}).items():
+            weight = self.weights.get(tag_name, 0.0) + sign * count * level
+            if weight > 1e-9:
+                self.weights[tag_name] = weight
+            else:
+                self.weights.pop(tag_name, None)
+
+    def decay(self, now=None, half_life_days=HISTORY_HALF_LIFE_DAYS):
+        # Applied in whole days, so play counts (and the result cache's
+        # fingerprint of them) only change once a day without new plays.
+        now = time.time() if now is None else now
+        days = int((now - self.decayed_at) // DAY_SECONDS)
+        if days <= 0 or not half_life_days:
+            return
+        factor = 0.5 ** (days / half_life_days)
+        for values in (self.plays, self.folded, self.levels, self.weights):
+            for key in values:
+                values[key] *= factor
+        self.decayed_at += days * DAY_SECONDS
+
+    def carry_known(self, previous):
+        # Tracks known from an earlier profile stay known, oldest first.
+        known = dict(previous.known)
+        for track_id, key in self.known.items():
+            known.pop(track_id, None)
+            known[track_id] = key
+        self.known = known
+        while len(self.known) > self.max_known:
+            del self.known[next(iter(self.known))]
+
+    def carry_folds(self, previous):
+        # Top tracks already folded into an earlier snapshot keep their tags
+        # and level, so fold() only fetches tags for tracks whose play count
+        # has changed since.
+        for track_id in heapq.nlargest(self.max_tracks, self.plays, key=self.plays.__getitem__):
+            if track_id in self.folded or not previous.folded.get(track_id):
+                continue
+            self.folded[track_id] = previous.folded[track_id]
+            self.levels[track_id] = previous.levels.get(track_id, 0.0)
+            self.tag_counts[track_id] = previous.tag_counts.get(track_id, {})
+            self.apply_weights(track_id, 1)
+
+    def top_tracks(self, limit=None):
+        limit = min(limit or self.max_tracks, self.max_tracks)
+        top = heapq.nlargest(limit, self.plays, key=self.plays.__getitem__)
+        tracks = []
+        for track_id in top:
+            track = self.tracks[track_id]
+            tracks.append(Track(track.name, track.artist, max(1, round(self.plays[track_id])), track.listeners,
+                                track.mbid, track.url))
+        return tracks
+
+    def unfolded(self):
+        top = heapq.nlargest(self.max_tracks, self.plays, key=self.plays.__getitem__)
+        return [self.tracks[track_id] for track_id in top if self.folded.get(track_id) != self.plays[track_id]]
+
+    def fold(self, track_tags):
+        # A track's level grows with log play count, so only the change since
+        # it was last folded is added. Its old share of the weights is taken
+        # out first, in case its tags have changed since.
+        for track in self.unfolded():
+            tags = track_tags.get(track.id)
+            if tags is None:
+                continue
+            plays = self.plays[track.id]
+            delta = math.log1p(plays) - math.log1p(self.folded.get(track.id, 0))
+            self.apply_weights(track.id, -1)
+            counts = {}
+            for tag in tags:
+                tag_name = tag.get('name', '').lower()
+                if tag_name:
+                    counts[tag_name] = counts.get(tag_name, 0) + int(tag.get('count', 1))
+            self.tag_counts[track.id] = counts
+            self.levels[track.id] = self.levels.get(track.id, 0.0) + delta
+            self.apply_weights(track.id, 1)
+            self.folded[track.id] = plays
+            self.known.pop(track.id, None)
+            self.known[track.id] = track.key
+        while len(self.known) > self.max_known:
+            del self.known[next(iter(self.known))]
+
+    def known_ids(self):
+        return set(self.known)
+
+    def top_tag_weights(self, limit):
+        return sorted(self.weights.items(), key=lambda x: x[1], reverse=True)[:limit]
+
+    def to_dict(self):
+        return {
+            'version': PROFILE_VERSION,
+            'tracks': [[track.name, track.artist, self.plays[track_id], track.listeners, track.mbid, track.url,
+                        self.folded.get(track_id, 0), self.levels.get(track_id, 0.0),
+                        self.tag_counts.get(track_id, {})]
+                       for track_id, track in self.tracks.items()],
+            'known': list(self.known.values()),
+            'total_plays': self.total_plays,
+            'decayed_at': self.decayed_at
+        }
+
+    @classmethod
+    def from_dict(cls, data, **options):
+        # Profiles stored before per-track tag counts were kept cannot have
+        # tracks taken out of their weights, so their tracks are folded in
+        # again from scratch; the tags mostly come from the tag cache.
+        profile = cls(**options)
+        current = data.get('version') == PROFILE_VERSION
+        for name, artist, plays, listeners, mbid, url, folded, *rest in data.get('tracks', []):
+            track = Track(name, artist, plays, listeners, mbid, url)
+            profile.tracks[track.id] = track
+            profile.plays[track.id] = plays
+            if current and folded:
+                level, tag_counts = rest
+                profile.folded[track.id] = folded
+                profile.levels[track.id] = level
+                profile.tag_counts[track.id] = tag_counts
+                profile.apply_weights(track.id, 1)
+        profile.known = {intern_key(key): key for key in data.get('known', [])}
+        profile.total_plays = data.get('total_plays', 0)
+        profile.decayed_at = data.get('decayed_at', profile.decayed_at)
+        return profile
+
+def ingest(profile, username, fetch_tags, previous=None, **options):
+    ingester = HistoryIngester(username, **options)
+    start = time.perf_counter()
+    plays_before = profile.total_plays
+    for track, plays in ingester:
+        profile.add(track, plays)
+    logger.info(f"Ingested {profile.total_plays - plays_before} plays from {ingester.pages}/{ingester.total_pages} history pages "
+                f"for {username} in {time.perf_counter() - start:.2f}s{' (truncated)' if ingester.truncated else ''}")
+    if previous is not None:
+        profile.carry_folds(previous)
+    unfolded = profile.unfolded()
+    if unfolded:
+        profile.fold(fetch_tags(unfolded))
+    return ingester
+
+def ingest_profile(username, fetch_tags, **options):
+    profile = TagProfile()
+    ingest(profile, username, fetch_tags, **options)
+    return profile
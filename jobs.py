@@ -0,0 +1,169 @@
+import os
+import json
+import time
+import uuid
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from sqlite_store import connect
+from track_cache import CACHE_DIR
+from admission import Rejected
+
+logger = logging.getLogger(__name__)
+
+JOBS_DB = os.path.join(CACHE_DIR, "jobs.db")
+RECOMMENDATION_JOB_WORKERS = int(os.getenv("RECOMMENDATION_JOB_WORKERS", "4"))
+JOB_STALE_SECONDS = 120
+JOB_HEARTBEAT_SECONDS = 30
+JOB_RETENTION_SECONDS = 60 * 60
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    username TEXT NOT NULL,
+    status TEXT NOT NULL,
+    stage TEXT,
+    result TEXT,
+    error TEXT,
+    rejected_status INTEGER,
+    retry_after INTEGER,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_username ON jobs (username, status);
+"""
+
+ACTIVE_STATUSES = ('queued', 'running')
+JOB_FIELDS = ['id', 'username', 'status', 'stage', 'result', 'error', 'rejected_status', 'retry_after', 'created_at', 'updated_at']
+
+def migrate(db):
+    columns = {row[1] for row in db.execute("PRAGMA table_info(jobs)")}
+    for column in ('rejected_status', 'retry_after'):
+        if column not in columns:
+            db.execute(f"ALTER TABLE jobs ADD COLUMN {column} INTEGER")
+
+class JobManager:
+    def __init__(self, run, path=JOBS_DB, max_workers=RECOMMENDATION_JOB_WORKERS, admission=None):
+        self.run = run
+        self.admission = admission
+        self.path = path
+        self.max_workers = max_workers
+        self.executor = None
+        self.lock = threading.Lock()
+        self.active = set()
+        self.heartbeat = None
+        self.migrated = False
+
+    def _db(self):
+        db = connect(self.path, SCHEMA)
+        if not self.migrated:
+            migrate(db)
+            self.migrated = True
+        return db
+
+    def _executor(self):
+        with self.lock:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="recommendation-job")
+                self.heartbeat = threading.Thread(target=self._heartbeat, name="recommendation-job-heartbeat", daemon=True)
+                self.heartbeat.start()
+            return self.executor
+
+    def _heartbeat(self):
+        # Jobs waiting in the executor queue, or in a long stage, write
+        # nothing; touching them keeps get() from reporting them as stopped.
+        while True:
+            time.sleep(JOB_HEARTBEAT_SECONDS)
+            with self.lock:
+                job_ids = list(self.active)
+            if not job_ids:
+                continue
+            try:
+                placeholders = ",".join("?" * len(job_ids))
+                self._db().execute(
+                    f"UPDATE jobs SET updated_at = ? WHERE id IN ({placeholders}) AND status IN (?, ?)",
+                    (time.time(), *job_ids, *ACTIVE_STATUSES))
+            except Exception as e:
+                logger.error(f"Error updating job heartbeats: {e}")
+
+    def _update(self, job_id, **fields):
+        fields['updated_at'] = time.time()
+        assignments = ", ".join(f"{name} = ?" for name in fields)
+        self._db().execute(f"UPDATE jobs SET {assignments} WHERE id = ?", (*fields.values(), job_id))
+
+    def submit(self, username):
+        now = time.time()
+        db = self._db()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            row = db.execute(
+                "SELECT id FROM jobs WHERE username = ? AND status IN (?, ?) AND updated_at > ? ORDER BY created_at DESC LIMIT 1",
+                (username.lower(), *ACTIVE_STATUSES, now - JOB_STALE_SECONDS)).fetchone()
+            if row is not None:
+                db.execute("COMMIT")
+                logger.info(f"Attaching to running job {row[0]} for {username}")
+                return row[0]
+            # Rejections from the admission controller propagate to the
+            # caller before any job row is written.
+            ticket = self.admission.reserve(username) if self.admission is not None else None
+            try:
+                job_id = uuid.uuid4().hex
+                db.execute(
+                    "INSERT INTO jobs (id, username, status, stage, created_at, updated_at) VALUES (?, ?, 'queued', 'queued', ?, ?)",
+                    (job_id, username.lower(), now, now))
+                db.execute("DELETE FROM jobs WHERE updated_at < ?", (now - JOB_RETENTION_SECONDS,))
+                db.execute("COMMIT")
+            except Exception:
+                if ticket is not None:
+                    ticket.release()
+                raise
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+        with self.lock:
+            self.active.add(job_id)
+        self._executor().submit(self._run_job, job_id, username, ticket)
+        logger.info(f"Submitted job {job_id} for {username}")
+        return job_id
+
+    def _run_job(self, job_id, username, ticket=None):
+        def progress(stage):
+            try:
+                self._update(job_id, stage=stage)
+            except Exception as e:
+                logger.error(f"Error updating job {job_id}: {e}")
+
+        start = time.time()
+        try:
+            if ticket is not None:
+                ticket.wait()
+            self._update(job_id, status='running', stage='started')
+            result = self.run(username, progress)
+            self._update(job_id, status='done', stage='done', result=json.dumps(result))
+            logger.info(f"Job {job_id} for {username} finished in {time.time() - start:.2f}s")
+        except Rejected as e:
+            # Timed out in the admission queue; kept apart from failures so
+            # the caller can answer with the status and Retry-After.
+            logger.warning(f"Job {job_id} for {username} rejected: {e}")
+            self._update(job_id, status='failed', stage='rejected', error=str(e),
+                         rejected_status=e.status, retry_after=e.retry_after)
+        except Exception as e:
+            logger.error(f"Job {job_id} for {username} failed: {e}")
+            self._update(job_id, status='failed', stage='failed', error=str(e))
+        finally:
+            if ticket is not None:
+                ticket.release()
+            with self.lock:
+                self.active.discard(job_id)
+
+    def get(self, job_id):
+        row = self._db().execute(
+            f"SELECT {', '.join(JOB_FIELDS)} FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = dict(zip(JOB_FIELDS, row))
+        job['result'] = json.loads(job['result']) if job['result'] else None
+        if job['status'] in ACTIVE_STATUSES and job['updated_at'] < time.time() - JOB_STALE_SECONDS:
+            job['status'] = 'failed'
+            job['error'] = "Job stopped responding"
+        return job
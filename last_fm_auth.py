@@ -10,4 +10,4 @@ def get_lastfm_api_secret():
     return os.getenv("LASTFM_API_SECRET")
 
 def get_lastfm_api_url():
-    return "http://ws.audioscrobbler.com/2.0/"
+    return os.getenv("LASTFM_API_URL", "http://ws.audioscrobbler.com/2.0/")
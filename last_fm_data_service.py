@@ -1,134 +1,471 @@
+import os
 import requests
 import logging
+import threading
 import time
 import random
+from concurrent.futures import Future
+from requests.adapters import HTTPAdapter
+import metrics
+from track_model import Track, as_tracks
 from last_fm_auth import get_lastfm_api_key, get_lastfm_api_url
 
 logger = logging.getLogger(__name__)
 
-def retry_api_call(func, max_retries=3, delay=1, *args, **kwargs):
-    for attempt in range(max_retries):
+# Last.fm averages the per-key rate over a five minute window, so the bucket
+# is deep enough to absorb a single recommendation request's burst.
+LASTFM_RATE_LIMIT = float(os.getenv("LASTFM_RATE_LIMIT", "5"))
+LASTFM_RATE_BURST = int(os.getenv("LASTFM_RATE_BURST", "250"))
+LASTFM_POOL_SIZE = int(os.getenv("LASTFM_POOL_SIZE", "16"))
+LASTFM_CONNECT_TIMEOUT = float(os.getenv("LASTFM_CONNECT_TIMEOUT", "3.05"))
+LASTFM_READ_TIMEOUT = float(os.getenv("LASTFM_READ_TIMEOUT", "10"))
+LASTFM_MAX_RETRIES = int(os.getenv("LASTFM_MAX_RETRIES", "3"))
+LASTFM_RETRY_DELAY = float(os.getenv("LASTFM_RETRY_DELAY", "0.2"))
+LASTFM_RETRY_MAX_DELAY = float(os.getenv("LASTFM_RETRY_MAX_DELAY", "1"))
+LASTFM_RATE_LIMIT_BACKOFF = float(os.getenv("LASTFM_RATE_LIMIT_BACKOFF", "0.25"))
+LASTFM_BREAKER_THRESHOLD = int(os.getenv("LASTFM_BREAKER_THRESHOLD", "5"))
+LASTFM_BREAKER_RESET = float(os.getenv("LASTFM_BREAKER_RESET", "30"))
+
+# Last.fm error codes that will fail the same way however often they are
+# retried: bad parameters (which includes unknown tracks and users), bad
+# methods and key or signature problems.
+PERMANENT_ERRORS = {2, 3, 4, 5, 6, 7, 10, 13, 26, 27}
+RATE_LIMIT_ERRORS = {29}
+
+class LastFmError(Exception):
+    def __init__(self, message, code=None, status=None):
+        super().__init__(message)
+        self.code = code
+        self.status = status
+
+    @property
+    def permanent(self):
+        if self.code is not None:
+            return self.code in PERMANENT_ERRORS
+        return self.status is not None and 400 <= self.status < 500 and self.status != 429
+
+    @property
+    def rate_limited(self):
+        return self.code in RATE_LIMIT_ERRORS or self.status == 429
+
+class CircuitOpenError(LastFmError):
+    pass
+
+class DeadlineExceeded(LastFmError):
+    pass
+
+def retry_delay(error, attempt, delay=LASTFM_RETRY_DELAY):
+    if error.rate_limited:
+        delay = LASTFM_RATE_LIMIT_BACKOFF
+    return min(LASTFM_RETRY_MAX_DELAY, delay * (2 ** attempt)) * random.uniform(0.5, 1.0)
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, deadline=None):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            if deadline is not None and time.monotonic() + wait >= deadline:
+                raise DeadlineExceeded(f"Rate limiter wait of {wait:.2f}s would pass the caller's deadline")
+            time.sleep(wait)
+
+    def penalize(self, seconds):
+        # Push every caller back, not just the one that hit the limit. Several
+        # threads hitting the limit together still only wait once.
+        with self.lock:
+            self.tokens = min(self.tokens, -seconds * self.rate)
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold=LASTFM_BREAKER_THRESHOLD, reset_timeout=LASTFM_BREAKER_RESET):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.lock = threading.Lock()
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = 0.0
+        self.counters = {'trips': 0, 'short_circuited': 0}
+
+    def allow(self):
+        with self.lock:
+            if self.state == 'closed':
+                return True
+            if time.monotonic() - self.opened_at >= self.reset_timeout:
+                # Let a single probe through; it closes or reopens the breaker.
+                # A probe that never reports back is replaced by a new one
+                # once it is as old as the reset timeout.
+                self.state = 'half_open'
+                self.opened_at = time.monotonic()
+                return True
+            self.counters['short_circuited'] += 1
+            return False
+
+    def record_success(self):
+        with self.lock:
+            self.state = 'closed'
+            self.failures = 0
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == 'half_open' or (self.state == 'closed' and self.failures >= self.failure_threshold):
+                if self.state == 'closed':
+                    logger.warning(f"Last.fm circuit breaker opened after {self.failures} consecutive failures")
+                self.state = 'open'
+                self.opened_at = time.monotonic()
+                self.counters['trips'] += 1
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters, breaker_open=int(self.state != 'closed'))
+
+class SingleFlight:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.counters = {'calls': 0, 'coalesced': 0}
+
+    def do(self, key, func, *args):
+        with self.lock:
+            future = self.calls.get(key)
+            leader = future is None
+            if leader:
+                future = self.calls[key] = Future()
+                self.counters['calls'] += 1
+            else:
+                self.counters['coalesced'] += 1
+        if not leader:
+            return future.result()
+
         try:
-            return func(*args, **kwargs)
-        except Exception as e:
-            logger.error(f"API call failed (attempt {attempt+1}/{max_retries}): {str(e)}")
-            if attempt < max_retries - 1:
-                sleep_time = delay * (2 ** attempt) + random.uniform(0, 0.5)
-                logger.info(f"Retrying in {sleep_time:.2f} seconds...")
+            result = func(*args)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self.lock:
+                del self.calls[key]
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters, in_flight=len(self.calls))
+
+def request_key(method, params):
+    return method.lower(), tuple(sorted((name, str(value).strip().lower()) for name, value in params.items()))
+
+class LastFmClient:
+    def __init__(self, api_key=None, api_url=None, rate_limit=LASTFM_RATE_LIMIT, burst=LASTFM_RATE_BURST,
+                 pool_size=LASTFM_POOL_SIZE, timeout=(LASTFM_CONNECT_TIMEOUT, LASTFM_READ_TIMEOUT)):
+        self.api_key = api_key or get_lastfm_api_key()
+        self.api_url = api_url or get_lastfm_api_url()
+        self.timeout = timeout
+        self.limiter = TokenBucket(rate_limit, burst)
+        self.singleflight = SingleFlight()
+        self.breaker = CircuitBreaker()
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=True)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def close(self):
+        self.session.close()
+
+    def stats(self):
+        return dict(self.singleflight.stats(), **self.breaker.stats())
+
+    def request(self, method, params=None, deadline=None):
+        params = dict(params or {})
+        logger.debug(f"Making Last.fm API request: {method} with params: {params}")
+        params.update({
+            'method': method,
+            'api_key': self.api_key,
+            'format': 'json'
+        })
+
+        self.limiter.acquire(deadline)
+        start = time.perf_counter()
+        status = 'error'
+        try:
+            try:
+                response = self.session.get(self.api_url, params=params, timeout=self.timeout)
+            except requests.RequestException as e:
+                # The exception text includes the URL, and with it the API key.
+                raise LastFmError(f"{type(e).__name__} calling {method}") from None
+            try:
+                data = response.json()
+            except ValueError:
+                data = None
+            if isinstance(data, dict) and 'error' in data:
+                status = 'api_error'
+                raise LastFmError(f"{method} failed: {data.get('message', '')}", data.get('error'), response.status_code)
+            if response.status_code >= 400 or data is None:
+                raise LastFmError(f"{method} failed with HTTP {response.status_code}", status=response.status_code)
+            status = 'ok'
+            return data
+        finally:
+            metrics.record_api_request(method, time.perf_counter() - start, status)
+
+    def request_with_retries(self, method, params, deadline=None):
+        # `deadline` is a time.monotonic() value past which no retry starts,
+        # for callers that stop waiting at a budget.
+        for attempt in range(LASTFM_MAX_RETRIES):
+            try:
+                result = self.request(method, params, deadline)
+            except DeadlineExceeded:
+                # Our own limiter said no; Last.fm was never asked, so the
+                # breaker has nothing to learn from it.
+                raise
+            except LastFmError as e:
+                if e.permanent:
+                    self.breaker.record_success()
+                    raise
+                if attempt == LASTFM_MAX_RETRIES - 1:
+                    self.breaker.record_failure()
+                    logger.error(f"Giving up on {method} after {attempt + 1} attempts: {e}")
+                    raise
+                sleep_time = retry_delay(e, attempt)
+                if e.rate_limited:
+                    self.limiter.penalize(sleep_time)
+                if deadline is not None and time.monotonic() + sleep_time >= deadline:
+                    self.breaker.record_failure()
+                    logger.info(f"{e}, not retrying past the caller's deadline")
+                    raise
+                metrics.record_retry()
+                logger.warning(f"{e} (attempt {attempt + 1}/{LASTFM_MAX_RETRIES}), retrying in {sleep_time:.2f}s")
                 time.sleep(sleep_time)
             else:
-                logger.error("Max retries reached, giving up.")
-                raise
+                self.breaker.record_success()
+                return result
 
-def make_lastfm_request(method, params=None):
-    if params is None:
-        params = {}
-    
-    api_key = get_lastfm_api_key()
-    api_url = get_lastfm_api_url()
-    
-    params.update({
-        'method': method,
-        'api_key': api_key,
-        'format': 'json'
-    })
-    
-    logger.info(f"Making Last.fm API request: {method} with params: {params}")
-    response = requests.get(api_url, params=params)
-    response.raise_for_status()
-    return response.json()
+    def call(self, method, params, deadline=None):
+        if not self.breaker.allow():
+            metrics.count("api_short_circuited")
+            raise CircuitOpenError(f"Last.fm circuit breaker is open, skipping {method}")
+        return self.singleflight.do(request_key(method, params), self.request_with_retries, method, params, deadline)
 
-def get_user_top_tracks(username, period='overall', limit=50):
-    try:
-        params = {
-            'user': username,
-            'period': period,
-            'limit': limit
-        }
-        
-        response = retry_api_call(make_lastfm_request, 3, 1, 'user.gettoptracks', params)
-        
-        if 'toptracks' in response and 'track' in response['toptracks']:
-            return response['toptracks']['track']
-        else:
-            logger.error("Unexpected response format from Last.fm API")
+    def get_user_top_tracks(self, username, period='overall', limit=50):
+        try:
+            params = {
+                'user': username,
+                'period': period,
+                'limit': limit
+            }
+
+            response = self.call('user.gettoptracks', params)
+
+            if 'toptracks' in response and 'track' in response['toptracks']:
+                return as_tracks(response['toptracks']['track'])
+            else:
+                logger.error("Unexpected response format from Last.fm API")
+                return []
+        except Exception as e:
+            logger.error(f"Failed to get top tracks: {str(e)}")
             return []
-    except Exception as e:
-        logger.error(f"Failed to get top tracks: {str(e)}")
-        return []
 
-def get_track_tags(artist_name, track_name, limit=10):
-    try:
+    def get_user_top_tracks_page(self, username, period='overall', page=1, limit=200):
+        try:
+            params = {
+                'user': username,
+                'period': period,
+                'page': page,
+                'limit': limit
+            }
+
+            response = self.call('user.gettoptracks', params)
+
+            if 'toptracks' in response and 'track' in response['toptracks']:
+                total_pages = int(response['toptracks'].get('@attr', {}).get('totalPages', 1) or 1)
+                return as_tracks(response['toptracks']['track']), total_pages
+            else:
+                logger.error(f"Unexpected response format from Last.fm API for top tracks page {page}")
+                return [], 0
+        except Exception as e:
+            logger.error(f"Failed to get top tracks page {page}: {str(e)}")
+            return [], 0
+
+    def get_user_recent_tracks_page(self, username, page=1, limit=200, since=None):
+        try:
+            params = {
+                'user': username,
+                'page': page,
+                'limit': limit
+            }
+            if since:
+                params['from'] = int(since) + 1
+
+            response = self.call('user.getrecenttracks', params)
+
+            if 'recenttracks' in response and 'track' in response['recenttracks']:
+                total_pages = int(response['recenttracks'].get('@attr', {}).get('totalPages', 1) or 1)
+                plays = response['recenttracks']['track']
+                if isinstance(plays, dict):
+                    plays = [plays]
+                # The track being played right now has no date yet.
+                return [(Track.from_lastfm(play), int(play['date']['uts'])) for play in plays if 'date' in play], total_pages
+            else:
+                logger.error(f"Unexpected response format from Last.fm API for recent tracks page {page}")
+                return [], 0
+        except Exception as e:
+            logger.error(f"Failed to get recent tracks page {page}: {str(e)}")
+            return [], 0
+
+    def fetch_track_tags(self, artist_name, track_name, limit=10, deadline=None):
+        # Unlike get_track_tags this raises LastFmError, so callers can tell
+        # a track Last.fm does not know from an API that is not answering.
         params = {
             'artist': artist_name,
             'track': track_name,
             'limit': limit
         }
-        
-        response = retry_api_call(make_lastfm_request, 3, 1, 'track.gettoptags', params)
-        
+
+        response = self.call('track.gettoptags', params, deadline)
+
         if 'toptags' in response and 'tag' in response['toptags']:
             return response['toptags']['tag']
-        else:
-            logger.error(f"Unexpected response format from Last.fm API for track {track_name}")
-            return []
-    except Exception as e:
-        logger.error(f"Failed to get tags for track {track_name}: {str(e)}")
+        logger.debug(f"No tags in Last.fm response for track {track_name}")
         return []
 
-def get_tracks_by_tag(tag_name, limit=50):
-    try:
+    def get_track_tags(self, artist_name, track_name, limit=10):
+        try:
+            return self.fetch_track_tags(artist_name, track_name, limit)
+        except Exception as e:
+            logger.error(f"Failed to get tags for track {track_name}: {str(e)}")
+            return []
+
+    def fetch_tracks_by_tag(self, tag_name, limit=50, deadline=None):
         params = {
             'tag': tag_name,
             'limit': limit
         }
-        
-        logger.info(f"Requesting top tracks for tag: {tag_name}")
-        response = retry_api_call(make_lastfm_request, 3, 1, 'tag.getTopTracks', params)
-        
+
+        logger.debug(f"Requesting top tracks for tag: {tag_name}")
+        response = self.call('tag.getTopTracks', params, deadline)
+
         if 'tracks' in response and 'track' in response['tracks']:
-            tracks = response['tracks']['track']
-            logger.info(f"Found {len(tracks)} tracks for tag: {tag_name}")
+            tracks = as_tracks(response['tracks']['track'])
+            logger.debug(f"Found {len(tracks)} tracks for tag: {tag_name}")
             return tracks
-        else:
-            logger.error(f"Unexpected response format from Last.fm API for tag {tag_name}")
-            logger.error(f"Response: {response}")
-            
-            if 'error' in response:
-                logger.error(f"Error code: {response.get('error')}, Message: {response.get('message')}")
-            
-            return []
-    except Exception as e:
-        logger.error(f"Failed to get tracks for tag {tag_name}: {str(e)}")
+        logger.debug(f"No tracks in Last.fm response for tag {tag_name}")
         return []
 
-def get_similar_tracks(artist_name, track_name, limit=20):
-    try:
+    def get_tracks_by_tag(self, tag_name, limit=50):
+        try:
+            return self.fetch_tracks_by_tag(tag_name, limit)
+        except Exception as e:
+            logger.error(f"Failed to get tracks for tag {tag_name}: {str(e)}")
+            return []
+
+    def fetch_similar_tracks(self, artist_name, track_name, limit=20, deadline=None):
         params = {
             'artist': artist_name,
             'track': track_name,
             'limit': limit
         }
-        
-        logger.info(f"Requesting similar tracks for {artist_name} - {track_name}")
-        response = retry_api_call(make_lastfm_request, 3, 1, 'track.getsimilar', params)
-        
-        logger.info(f"Response keys: {response.keys()}")
-        if 'similartracks' in response:
-            logger.info(f"similartracks keys: {response['similartracks'].keys()}")
-        
+
+        logger.debug(f"Requesting similar tracks for {artist_name} - {track_name}")
+        response = self.call('track.getsimilar', params, deadline)
+
         if 'similartracks' in response and 'track' in response['similartracks']:
-            similar_tracks = response['similartracks']['track']
-            logger.info(f"Found {len(similar_tracks)} similar tracks for {artist_name} - {track_name}")
+            similar_tracks = as_tracks(response['similartracks']['track'])
+            logger.debug(f"Found {len(similar_tracks)} similar tracks for {artist_name} - {track_name}")
             return similar_tracks
-        else:
-            logger.error(f"Unexpected response format from Last.fm API for track {track_name}")
-            logger.error(f"Response: {response}")
-            
-            if 'error' in response:
-                logger.error(f"Error code: {response.get('error')}, Message: {response.get('message')}")
-            
-            return []
-    except Exception as e:
-        logger.error(f"Failed to get similar tracks for {track_name}: {str(e)}")
+        logger.error(f"Unexpected response format from Last.fm API for track {track_name}")
         return []
+
+    def get_similar_tracks(self, artist_name, track_name, limit=20):
+        try:
+            return self.fetch_similar_tracks(artist_name, track_name, limit)
+        except Exception as e:
+            logger.error(f"Failed to get similar tracks for {track_name}: {str(e)}")
+            return []
+
+    def get_top_tags(self, limit=50):
+        try:
+            params = {
+                'limit': limit
+            }
+
+            response = self.call('chart.getTopTags', params)
+
+            if 'tags' in response and 'tag' in response['tags']:
+                return response['tags']['tag']
+            else:
+                logger.error("Unexpected response format from Last.fm API for top tags")
+                return []
+        except Exception as e:
+            logger.error(f"Failed to get top tags: {str(e)}")
+            return []
+
+_default_client = None
+_default_client_lock = threading.Lock()
+
+def get_client():
+    global _default_client
+    if _default_client is None:
+        with _default_client_lock:
+            if _default_client is None:
+                _default_client = LastFmClient()
+    return _default_client
+
+def client_stats():
+    return _default_client.stats() if _default_client is not None else None
+
+metrics.register_collector(metrics.stats_collector('lastfm_client', client_stats, "Last.fm client request coalescing and circuit breaker"))
+
+def configure_client(**options):
+    global _default_client
+    with _default_client_lock:
+        _default_client = LastFmClient(**options)
+    return _default_client
+
+def reset_client():
+    global _default_client
+    with _default_client_lock:
+        _default_client = None
+
+def make_lastfm_request(method, params=None):
+    return get_client().request(method, params)
+
+def get_user_top_tracks(username, period='overall', limit=50):
+    return get_client().get_user_top_tracks(username, period, limit)
+
+def get_user_top_tracks_page(username, period='overall', page=1, limit=200):
+    return get_client().get_user_top_tracks_page(username, period, page, limit)
+
+def get_user_recent_tracks_page(username, page=1, limit=200, since=None):
+    return get_client().get_user_recent_tracks_page(username, page, limit, since)
+
+def fetch_track_tags(artist_name, track_name, limit=10, deadline=None):
+    return get_client().fetch_track_tags(artist_name, track_name, limit, deadline)
+
+def get_track_tags(artist_name, track_name, limit=10):
+    return get_client().get_track_tags(artist_name, track_name, limit)
+
+def fetch_tracks_by_tag(tag_name, limit=50, deadline=None):
+    return get_client().fetch_tracks_by_tag(tag_name, limit, deadline)
+
+def get_tracks_by_tag(tag_name, limit=50):
+    return get_client().get_tracks_by_tag(tag_name, limit)
+
+def fetch_similar_tracks(artist_name, track_name, limit=20, deadline=None):
+    return get_client().fetch_similar_tracks(artist_name, track_name, limit, deadline)
+
+def get_similar_tracks(artist_name, track_name, limit=20):
+    return get_client().get_similar_tracks(artist_name, track_name, limit)
+
+def get_top_tags(limit=50):
+    return get_client().get_top_tags(limit)
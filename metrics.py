@@ -0,0 +1,218 @@
+import time
+import bisect
+import logging
+import threading
+import contextvars
+from functools import wraps
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+METRICS = {
+    'lastfm_stage_seconds': ('histogram', "Time spent in each recommendation pipeline stage."),
+    'lastfm_api_request_seconds': ('histogram', "Latency of individual Last.fm API requests."),
+    'lastfm_api_requests_total': ('counter', "Last.fm API requests by method and outcome."),
+    'lastfm_api_retries_total': ('counter', "Last.fm API requests retried after a failure."),
+    'lastfm_cache_lookups_total': ('counter', "Cache lookups by cache and result.")
+}
+
+class Registry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.collectors = []
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [[0] * len(LATENCY_BUCKETS), 0.0, 0]
+            index = bisect.bisect_left(LATENCY_BUCKETS, value)
+            if index < len(LATENCY_BUCKETS):
+                histogram[0][index] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def register_collector(self, collect):
+        with self.lock:
+            self.collectors.append(collect)
+
+    def render(self):
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((key, (list(buckets), total, count)) for key, (buckets, total, count) in self.histograms.items())
+            collectors = list(self.collectors)
+
+        lines = []
+        described = set()
+
+        def describe(name, kind, text):
+            if name not in described:
+                described.add(name)
+                lines.append(f"# HELP {name} {text}")
+                lines.append(f"# TYPE {name} {kind}")
+
+        for (name, labels), value in counters:
+            kind, text = METRICS.get(name, ('counter', name))
+            describe(name, kind, text)
+            lines.append(f"{name}{format_labels(labels)} {value}")
+
+        for (name, labels), (buckets, total, count) in histograms:
+            kind, text = METRICS.get(name, ('histogram', name))
+            describe(name, kind, text)
+            cumulative = 0
+            for bound, bucket_count in zip(LATENCY_BUCKETS, buckets):
+                cumulative += bucket_count
+                lines.append(f"{name}_bucket{format_labels(labels + (('le', repr(bound)),))} {cumulative}")
+            lines.append(f"{name}_bucket{format_labels(labels + (('le', '+Inf'),))} {count}")
+            lines.append(f"{name}_sum{format_labels(labels)} {total}")
+            lines.append(f"{name}_count{format_labels(labels)} {count}")
+
+        for collect in collectors:
+            try:
+                samples = list(collect())
+            except Exception as e:
+                logger.error(f"Error collecting metrics: {e}")
+                continue
+            for name, kind, text, labels, value in samples:
+                describe(name, kind, text)
+                lines.append(f"{name}{format_labels(tuple(sorted(labels.items())))} {value}")
+
+        return "\n".join(lines) + "\n"
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + "}"
+
+class Trace:
+    def __init__(self, name):
+        self.name = name
+        self.started = time.perf_counter()
+        self.lock = threading.Lock()
+        self.stages = {}
+        self.counts = {}
+
+    def add_stage(self, stage, elapsed):
+        with self.lock:
+            self.stages[stage] = self.stages.get(stage, 0.0) + elapsed
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + amount
+
+    def summary(self):
+        with self.lock:
+            stages = " ".join(f"{stage}={elapsed * 1000:.0f}ms" for stage, elapsed in self.stages.items())
+            counts = " ".join(f"{name}={value}" for name, value in sorted(self.counts.items()))
+        total = time.perf_counter() - self.started
+        return " ".join(part for part in (f"{self.name} total={total * 1000:.0f}ms", stages, counts) if part)
+
+registry = Registry()
+_current_trace = contextvars.ContextVar('lastfm_trace', default=None)
+
+def inc(name, amount=1, **labels):
+    registry.inc(name, amount, **labels)
+
+def observe(name, value, **labels):
+    registry.observe(name, value, **labels)
+
+def register_collector(collect):
+    registry.register_collector(collect)
+
+def render():
+    return registry.render()
+
+def current_trace():
+    return _current_trace.get()
+
+def count(name, amount=1):
+    trace_ = _current_trace.get()
+    if trace_ is not None:
+        trace_.count(name, amount)
+
+@contextmanager
+def trace(name):
+    trace_ = Trace(name)
+    token = _current_trace.set(trace_)
+    try:
+        yield trace_
+    finally:
+        _current_trace.reset(token)
+
+def bind_trace(func):
+    # Executor threads do not inherit context variables, so carry the
+    # caller's trace over to whichever thread ends up running func.
+    trace_ = _current_trace.get()
+    if trace_ is None:
+        return func
+
+    @wraps(func)
+    def run(*args, **kwargs):
+        token = _current_trace.set(trace_)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _current_trace.reset(token)
+    return run
+
+@contextmanager
+def stage(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        registry.observe('lastfm_stage_seconds', elapsed, stage=name)
+        trace_ = _current_trace.get()
+        if trace_ is not None:
+            trace_.add_stage(name, elapsed)
+
+def timed(name):
+    def decorator(func):
+        @wraps(func)
+        def run(*args, **kwargs):
+            with stage(name):
+                return func(*args, **kwargs)
+        return run
+    return decorator
+
+def record_api_request(method, elapsed, status):
+    method = method.lower()
+    registry.inc('lastfm_api_requests_total', method=method, status=status)
+    registry.observe('lastfm_api_request_seconds', elapsed, method=method)
+    count(f"api.{method}")
+    if status != 'ok':
+        count("api_errors")
+
+def record_retry():
+    registry.inc('lastfm_api_retries_total')
+    count("api_retries")
+
+def record_cache_lookups(cache, hits, misses):
+    if hits:
+        registry.inc('lastfm_cache_lookups_total', hits, cache=cache, result='hit')
+        count(f"{cache}.hits", hits)
+    if misses:
+        registry.inc('lastfm_cache_lookups_total', misses, cache=cache, result='miss')
+        count(f"{cache}.misses", misses)
+
+def stats_collector(prefix, stats_func, help_text):
+    def collect():
+        stats = stats_func()
+        if stats is None:
+            return
+        for key, value in stats.items():
+            if isinstance(value, (int, float)):
+                yield f"{prefix}_{key}", 'gauge', f"{help_text} ({key}).", {}, value
+    return collect
@@ -0,0 +1,99 @@
+import os
+import json
+import time
+import logging
+import threading
+from sqlite_store import connect
+from track_cache import CACHE_DIR
+from history import TagProfile, ingest, HISTORY_SOURCE, HISTORY_PERIOD
+
+logger = logging.getLogger(__name__)
+
+PROFILES_DB = os.path.join(CACHE_DIR, "profiles.db")
+PROFILE_RETENTION_DAYS = int(os.getenv("PROFILE_RETENTION_DAYS", "90"))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS profiles (
+    username TEXT PRIMARY KEY,
+    profile TEXT NOT NULL,
+    last_sync INTEGER,
+    updated_at REAL NOT NULL
+);
+"""
+
+class ProfileStore:
+    def __init__(self, path=PROFILES_DB):
+        self.path = path
+        self.lock = threading.Lock()
+        self.counters = {'created': 0, 'synced': 0, 'plays_ingested': 0}
+
+    def _db(self):
+        return connect(self.path, SCHEMA)
+
+    def _count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] += amount
+
+    def load(self, username):
+        row = self._db().execute(
+            "SELECT profile, last_sync FROM profiles WHERE username = ?", (username.lower(),)).fetchone()
+        if row is None:
+            return None, None
+        return TagProfile.from_dict(json.loads(row[0])), row[1]
+
+    def save(self, username, profile, last_sync):
+        self._db().execute(
+            "INSERT OR REPLACE INTO profiles (username, profile, last_sync, updated_at) VALUES (?, ?, ?, ?)",
+            (username.lower(), json.dumps(profile.to_dict()), last_sync, time.time()))
+
+    def sync(self, username, fetch_tags, source=HISTORY_SOURCE, period=HISTORY_PERIOD):
+        try:
+            stored, last_sync = self.load(username)
+        except Exception as e:
+            logger.error(f"Error loading profile for {username}: {e}")
+            stored, last_sync = None, None
+        self._count('created' if stored is None else 'synced')
+
+        if source == 'recent':
+            # Scrobbles are read newest first and the next sync starts after
+            # the newest one, so plays left unread by the page cap or time
+            # budget are skipped for good; the recent ones are what matter
+            # here. Older plays fade through the profile's decay instead.
+            profile = stored or TagProfile()
+            profile.decay()
+            plays_before = profile.total_plays
+            ingester = ingest(profile, username, fetch_tags, source='recent', since=last_sync)
+            self._count('plays_ingested', profile.total_plays - plays_before)
+        else:
+            # Top tracks for a period are a snapshot rather than new plays,
+            # so the profile is rebuilt from it. Tracks already in the stored
+            # profile keep their tags, and only the ones whose play count
+            # moved are folded again.
+            profile = TagProfile()
+            ingester = ingest(profile, username, fetch_tags, previous=stored, source=source, period=period)
+            self._count('plays_ingested', profile.total_plays)
+            if stored is not None:
+                profile.carry_known(stored)
+
+        # A failed page leaves a gap behind the newest scrobble read. Saving
+        # would move the next sync past it, so the stored profile is left
+        # as it was and the next sync reads the same plays again.
+        if ingester.failed_pages:
+            logger.warning(f"Not saving profile for {username}: {ingester.failed_pages} history pages failed")
+        elif ingester.pages and ingester.total_pages:
+            try:
+                self.save(username, profile, ingester.latest_timestamp)
+            except Exception as e:
+                logger.error(f"Error saving profile for {username}: {e}")
+        return profile
+
+    def delete(self, username):
+        self._db().execute("DELETE FROM profiles WHERE username = ?", (username.lower(),))
+
+    def purge_expired(self):
+        cutoff = time.time() - PROFILE_RETENTION_DAYS * 24 * 60 * 60
+        return self._db().execute("DELETE FROM profiles WHERE updated_at < ?", (cutoff,)).rowcount
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters)
@@ -1,298 +1,468 @@
+import os
 import logging
-import pandas as pd
 import random
+import numpy as np
+from scipy import sparse
+from itertools import chain
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import metrics
 from recommender import Recommender
-from last_fm_data_service import get_track_tags as api_get_track_tags, get_similar_tracks as api_get_similar_tracks, get_tracks_by_tag as api_get_tracks_by_tag
-from track_cache import get_tracks_for_tag
+from last_fm_data_service import LastFmError, fetch_track_tags as api_fetch_track_tags, fetch_tracks_by_tag as api_fetch_tracks_by_tag
+from track_cache import get_tracks_for_tags, NEGATIVE_CACHE_TTL
+from track_tag_cache import TrackTagCache
+from tag_similarity import TagSimilarityEngine
+from track_features import build_track_features
+from track_model import make_key, as_tracks
+from candidate_index import get_candidate_index
+from candidate_planner import CandidatePlanner, Budget, CANDIDATE_MAX_TAGS, CANDIDATE_MAX_SEEDS
+from tag_embedding import get_tag_embedding, embedding_stats
 
 logger = logging.getLogger(__name__)
-tag_cache = {}
+tag_cache = TrackTagCache()
+metrics.register_collector(metrics.stats_collector('lastfm_tag_cache', tag_cache.stats, "Track tag cache"))
+metrics.register_collector(metrics.stats_collector('lastfm_tag_embedding', embedding_stats, "Tag embedding vector cache"))
+
+TAG_FETCH_CONCURRENCY = int(os.getenv("TAG_FETCH_CONCURRENCY", "8"))
+INDEX_CANDIDATES_PER_SEED = int(os.getenv("INDEX_CANDIDATES_PER_SEED", "5"))
+STREAM_BATCHES = 4
+FALLBACK_TAGS = 15
+FALLBACK_TRACKS_PER_TAG = 30
+FALLBACK_SIZE = 20
+
+FALLBACK_MESSAGE = "Our recommendation algorithm couldn't find perfect matches, but here are some songs you might still enjoy."
+ERROR_FALLBACK_MESSAGE = "Our recommendation algorithm encountered an error, but here are some songs you might still enjoy."
+
+def fetch_track_tags(artist, name, deadline=None):
+    # Returns [] for tracks Last.fm has no tags for, which is worth caching,
+    # and None when the API could not be reached, which is not.
+    try:
+        return api_fetch_track_tags(artist, name, deadline=deadline)
+    except LastFmError as e:
+        if e.permanent:
+            return []
+        logger.warning(f"Tags for {artist} - {name} unavailable: {e}")
+        return None
+
+def cache_track_tags(fetched):
+    tag_cache.set_many({key: tags for key, tags in fetched.items() if tags})
+    tag_cache.set_many({key: tags for key, tags in fetched.items() if tags == []}, ttl=NEGATIVE_CACHE_TTL)
 
 def get_track_tags(artist, name):
-    key = f"{artist}|{name}".lower()
-    if key not in tag_cache:
-        tag_cache[key] = api_get_track_tags(artist, name)
-    return tag_cache[key]
+    key = make_key(artist, name)
+    tags = tag_cache.get(key)
+    if tags is None:
+        tags = fetch_track_tags(artist, name)
+        cache_track_tags({key: tags})
+    return tags or []
 
-def prepare_track_data(tracks):
-    tracks_data = []
+def lookup_cached_tags(tracks):
+    by_key = {}
     for track in tracks:
-        artist_name = track.get('artist', {}).get('name', 'Unknown') if isinstance(track.get('artist'), dict) else track.get('artist', 'Unknown')
-        track_name = track.get('name', 'Unknown')
-        track_data = {
-            'name': track_name,
-            'artist': artist_name,
-            'playcount': int(track.get('playcount', 0)),
-            'listeners': int(track.get('listeners', 0)) if 'listeners' in track else 0,
-            'mbid': track.get('mbid', ''),
-            'url': track.get('url', '')
-        }
-        tags = get_track_tags(artist_name, track_name)
-        if not tags:
-            continue
-        for i, tag in enumerate(tags[:10]):
-            tag_name = tag.get('name', '').lower()
-            tag_weight = float(tag.get('count', 0))
-            if tag_name:
-                track_data[f'tag_{i}_name'] = tag_name
-                track_data[f'tag_{i}_weight'] = tag_weight
-        tracks_data.append(track_data)
-    return tracks_data, len(tracks_data) > 0
-
-def create_tag_vector(track_tags, all_possible_tags):
-    vector = [0.0] * len(all_possible_tags)
-    tag_weights = {tag['name'].lower(): float(tag.get('count', 0)) for tag in track_tags if 'name' in tag}
-    for i, tag in enumerate(all_possible_tags):
-        if tag in tag_weights:
-            vector[i] = tag_weights[tag]
-    return vector
-
-def cosine_similarity(vec1, vec2):
-    dot_product = sum(a * b for a, b in zip(vec1, vec2))
-    norm1 = sum(a * a for a in vec1) ** 0.5
-    norm2 = sum(b * b for b in vec2) ** 0.5
-    if norm1 == 0 or norm2 == 0:
-        return 0.0
-    return dot_product / (norm1 * norm2)
+        by_key.setdefault(track.key, track)
+
+    cached = tag_cache.get_many(by_key)
+    missing = [track for key, track in by_key.items() if key not in cached]
+    metrics.record_cache_lookups('tag_cache', len(cached), len(missing))
+    return {by_key[key].id: tags for key, tags in cached.items()}, missing
+
+def iter_track_tags(tracks, max_workers=None, deadline=None):
+    found, missing = lookup_cached_tags(tracks)
+    yield from found.items()
+    yield from fetch_missing_tags(missing, max_workers, deadline)
+
+def fetch_missing_tags(missing, max_workers=None, deadline=None, on_submit=None):
+    # Only as many lookups as there are workers are submitted at a time, and
+    # each worker caches what it fetched. A caller that stops iterating
+    # early leaves at most `workers` calls running, and their results are
+    # still kept. `on_submit` is called once per lookup actually started.
+    if not missing:
+        return
+
+    workers = max(1, min(max_workers or TAG_FETCH_CONCURRENCY, len(missing)))
+    logger.info(f"Fetching tags for {len(missing)} tracks with {workers} workers")
+
+    def fetch(track):
+        tags = fetch_track_tags(track.artist, track.name, deadline)
+        cache_track_tags({track.key: tags})
+        return tags
+
+    fetch = metrics.bind_trace(fetch)
+    executor = ThreadPoolExecutor(max_workers=workers)
+    pending = {}
+    tracks = iter(missing)
+
+    def submit():
+        track = next(tracks, None)
+        if track is not None:
+            pending[executor.submit(fetch, track)] = track
+            if on_submit is not None:
+                on_submit()
+
+    try:
+        for _ in range(workers):
+            submit()
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                track = pending.pop(future)
+                # None (unavailable) is passed on so profiles fold the track later.
+                yield track.id, future.result()
+                submit()
+    finally:
+        executor.shutdown(wait=False)
+
+@metrics.timed('tags')
+def get_track_tags_many(tracks, max_workers=None, deadline=None):
+    return dict(iter_track_tags(tracks, max_workers, deadline))
+
+def prepare_track_data(tracks, known_ids=(), include_counts=True, track_tags=None):
+    if track_tags is None:
+        track_tags = get_track_tags_many(tracks)
+    with metrics.stage('features'):
+        # With a trained embedding, tracks are ranked on fixed-width tag
+        # vectors instead of a sparse matrix over this request's tags. Play
+        # and listener counts have no place in it.
+        embedding = None if include_counts else get_tag_embedding()
+        if embedding is not None:
+            features, tracks = embedding.vectors_for(tracks, track_tags)
+            known = np.fromiter((track.id in known_ids for track in tracks), dtype=bool, count=len(tracks))
+        else:
+            features, tracks, known, _ = build_track_features(tracks, track_tags, known_ids, include_counts)
+    return features, tracks, known
+
+def find_similar_tracks_many(source_tracks, candidate_tracks, num_similar=5, track_tags=None):
+    if track_tags is None:
+        track_tags = get_track_tags_many(list(source_tracks) + list(candidate_tracks))
+    candidates = [track for track in candidate_tracks if track_tags.get(track.id)]
+    candidate_positions = {}
+    for position, track in enumerate(candidates):
+        candidate_positions.setdefault(track.id, []).append(position)
+    exclude = [(seed_index, candidate_index)
+               for seed_index, track in enumerate(source_tracks)
+               for candidate_index in candidate_positions.get(track.id, ())]
+    matches = TagSimilarityEngine().top_k(
+        [track_tags.get(track.id) for track in source_tracks],
+        [track_tags[track.id] for track in candidates],
+        num_similar,
+        exclude
+    )
+    return [[candidates[i] for i, _ in seed_matches] for seed_matches in matches]
 
 def find_similar_tracks_vector(source_track, candidate_tracks, num_similar=5):
-    all_tags = set()
-    source_artist = source_track.get('artist', {}).get('name', '') if isinstance(source_track.get('artist'), dict) else source_track.get('artist', '')
-    source_name = source_track.get('name', '')
-    source_tags = get_track_tags(source_artist, source_name)
-    if not source_tags:
-        return []
-    for tag in source_tags:
-        if 'name' in tag:
-            all_tags.add(tag['name'].lower())
-    candidate_tags = {}
-    for track in candidate_tracks:
-        artist = track.get('artist', {}).get('name', '') if isinstance(track.get('artist'), dict) else track.get('artist', '')
-        name = track.get('name', '')
-        track_id = f"{artist}|{name}".lower()
-        track_tags = get_track_tags(artist, name)
-        if not track_tags:
-            continue
-        candidate_tags[track_id] = track_tags
-        for tag in track_tags:
-            if 'name' in tag:
-                all_tags.add(tag['name'].lower())
-    all_tags_list = list(all_tags)
-    source_vector = create_tag_vector(source_tags, all_tags_list)
-    similarities = []
-    for track in candidate_tracks:
-        artist = track.get('artist', {}).get('name', '') if isinstance(track.get('artist'), dict) else track.get('artist', '')
-        name = track.get('name', '')
-        track_id = f"{artist}|{name}".lower()
-        if track_id == f"{source_artist}|{source_name}".lower():
-            continue
-        if track_id not in candidate_tags:
-            continue
-        track_vector = create_tag_vector(candidate_tags[track_id], all_tags_list)
-        similarity = cosine_similarity(source_vector, track_vector)
-        similarities.append((track, similarity))
-    similarities.sort(key=lambda x: x[1], reverse=True)
-    return [track for track, sim in similarities[:num_similar]]
+    return find_similar_tracks_many([source_track], candidate_tracks, num_similar)[0]
 
-def get_new_tracks_from_lastfm(top_tracks):
+def dedupe_tracks(tracks, exclude=()):
+    seen = set(exclude)
+    unique_tracks = []
+    for track in tracks:
+        if track.id not in seen:
+            seen.add(track.id)
+            unique_tracks.append(track)
+    return unique_tracks
+
+def aggregate_tag_weights(top_tracks, top_track_tags, limit):
     all_tags = {}
     for track in top_tracks:
-        artist_name = track.get('artist', {}).get('name', '') if isinstance(track.get('artist'), dict) else track.get('artist', '')
-        track_name = track.get('name', '')
-        if not artist_name or not track_name:
+        if not track.artist or not track.name:
             continue
-        tags = get_track_tags(artist_name, track_name)
+        tags = top_track_tags.get(track.id)
         if not tags:
             continue
         for tag in tags:
             tag_name = tag.get('name', '').lower()
             if tag_name:
                 all_tags[tag_name] = all_tags.get(tag_name, 0) + int(tag.get('count', 1))
-    if not all_tags:
+    return sorted(all_tags.items(), key=lambda x: x[1], reverse=True)[:limit]
+
+def profile_tag_weights(profile, top_tracks, top_track_tags, limit):
+    if profile is None:
+        return aggregate_tag_weights(top_tracks, top_track_tags, limit)
+    return profile.top_tag_weights(limit)
+
+def known_track_ids(top_tracks, profile=None):
+    known_ids = {track.id for track in top_tracks}
+    if profile is not None:
+        known_ids |= profile.known_ids()
+    return known_ids
+
+class PipelineContext:
+    # Everything one request has fetched or derived so far. Stages ask the
+    # context instead of recomputing, so a fallback after a failed pass
+    # reuses the tags, tag lists and candidates that pass already paid for.
+    # The budget's clock starts here, so the seeds' own tag lookups count
+    # against the request's time budget as well as the planner's work.
+    def __init__(self, top_tracks, profile=None, progress=None, budget=None):
+        self.top_tracks = as_tracks(top_tracks)
+        self.profile = profile
+        self.progress = progress
+        self.budget = budget or Budget()
+        self.track_tags = {}
+        self.tag_tracks = {}
+        self.results = {}
+
+    def memo(self, name, compute):
+        if name not in self.results:
+            self.results[name] = compute()
+        return self.results[name]
+
+    def report(self, stage):
+        report_progress(self.progress, stage)
+
+    def top_track_tags(self):
+        def compute():
+            tags = get_track_tags_many(self.top_tracks, deadline=self.budget.deadline)
+            self.track_tags.update(tags)
+            return tags
+        return self.memo('top_track_tags', compute)
+
+    def known_ids(self):
+        return self.memo('known_ids', lambda: known_track_ids(self.top_tracks, self.profile))
+
+    def tag_weights(self, limit):
+        return self.memo(('tag_weights', limit),
+                         lambda: profile_tag_weights(self.profile, self.top_tracks, self.top_track_tags(), limit))
+
+    def seeds(self):
+        return self.memo('seeds', lambda: [track for track in self.top_tracks if self.top_track_tags().get(track.id)])
+
+    def planner(self):
+        return self.memo('planner', lambda: CandidatePlanner(
+            self.seeds()[:CANDIDATE_MAX_SEEDS], self.tag_weights(CANDIDATE_MAX_TAGS), self.known_ids(),
+            self.budget, lookup_cached_tags, fetch_missing_tags))
+
+    def candidate_pool(self):
+        def compute():
+            planner = self.planner()
+            pool = planner.expand()
+            self.tag_tracks.update(planner.tag_tracks)
+            return pool
+        return self.memo('candidate_pool', compute)
+
+    def iter_candidate_tags(self):
+        planner = self.planner()
+        for track_id, tags in planner.iter_tags():
+            self.track_tags[track_id] = tags
+            yield track_id, tags
+        self.results['candidate_tags'] = True
+        logger.info(planner.summary())
+
+    def candidate_tags(self):
+        if 'candidate_tags' not in self.results:
+            for _ in self.iter_candidate_tags():
+                pass
+        return self.track_tags
+
+    def tracks_for_tags(self, tags, limit):
+        missing = [tag for tag in tags if tag not in self.tag_tracks]
+        if missing:
+            self.tag_tracks.update(get_tracks_for_tags(missing, api_fetch_tracks_by_tag, limit=limit))
+        return {tag: self.tag_tracks[tag] for tag in tags}
+
+@metrics.timed('candidates')
+def get_new_tracks_from_lastfm(context):
+    pool = context.candidate_pool()
+    if not pool:
         return []
-    sorted_tags = sorted(all_tags.items(), key=lambda x: x[1], reverse=True)
-    top_tags = [tag for tag, count in sorted_tags[:10]]
-    candidate_tracks = []
-    for tag in top_tags:
-        tag_tracks = get_tracks_for_tag(tag, api_get_tracks_by_tag, limit=20)
-        if tag_tracks:
-            candidate_tracks.extend(tag_tracks)
-            logger.info(f"Added {len(tag_tracks)} tracks from tag '{tag}'")
-    seen_keys = set()
-    unique_similar_tracks = []
-    for track in candidate_tracks:
-        artist_name = track.get('artist', {}).get('name', '') if isinstance(track.get('artist'), dict) else track.get('artist', '')
-        track_name = track.get('name', '')
-        key = f"{artist_name}|{track_name}".lower()
-        if key and key not in seen_keys:
-            seen_keys.add(key)
-            unique_similar_tracks.append(track)
+    track_tags = context.candidate_tags()
     results = []
-    for top_track in top_tracks:
-        vector_similar = find_similar_tracks_vector(top_track, unique_similar_tracks, num_similar=2)
+    for vector_similar in find_similar_tracks_many(context.top_tracks, pool, num_similar=2, track_tags=track_tags):
         results.extend(vector_similar)
-    seen = set()
-    deduped = []
-    for track in results:
-        key = f"{track.get('artist', {}).get('name', '') if isinstance(track.get('artist'), dict) else track.get('artist', '')}|{track.get('name', '')}".lower()
-        if key not in seen:
-            seen.add(key)
-            deduped.append(track)
+    deduped = dedupe_tracks(results)
     random.shuffle(deduped)
     return deduped
 
-def generate_recommendations(top_tracks):
-    try:
-        similar_tracks = get_new_tracks_from_lastfm(top_tracks)
-        if not similar_tracks:
-            logger.warning("No similar tracks found, trying with different settings")
-            fallback_tracks, _ = fallback_recommendations(top_tracks)
-            return fallback_tracks, "Our recommendation algorithm couldn't find perfect matches, but here are some songs you might still enjoy."
-
-        known_tracks = set()
-        for track in top_tracks:
-            artist_name = track.get('artist', {}).get('name', '') if isinstance(track.get('artist'), dict) else track.get('artist', '')
-            track_name = track.get('name', '')
-            known_tracks.add(f"{artist_name}|{track_name}".lower())
-
-        new_similar_tracks = []
-        for track in similar_tracks:
-            artist_name = track.get('artist', {}).get('name', '') if isinstance(track.get('artist'), dict) else track.get('artist', '')
-            track_name = track.get('name', '')
-            track_key = f"{artist_name}|{track_name}".lower()
-            if track_key not in known_tracks:
-                new_similar_tracks.append(track)
-
-        if not new_similar_tracks:
-            logger.warning("No new similar tracks found, trying fallback")
-            fallback_tracks, _ = fallback_recommendations(top_tracks)
-            return fallback_tracks, "Our recommendation algorithm couldn't find perfect matches, but here are some songs you might still enjoy."
-
-        tracks_data, success = prepare_track_data(top_tracks + new_similar_tracks)
-        if not success or not tracks_data:
-            logger.warning("Failed to prepare track data, trying fallback")
-            fallback_tracks, _ = fallback_recommendations(top_tracks)
-            return fallback_tracks, "Our recommendation algorithm couldn't find perfect matches, but here are some songs you might still enjoy."
-
-        tracks_df = pd.DataFrame(tracks_data)
-        tag_columns = [col for col in tracks_df.columns if col.startswith('tag_') and col.endswith('_name')]
-        all_tags = set()
-        for col in tag_columns:
-            all_tags.update(tracks_df[col].dropna().unique())
-        for tag in all_tags:
-            tracks_df[f'tag_{tag}'] = 0
-            for col in tag_columns:
-                weight_col = col.replace('_name', '_weight')
-                mask = tracks_df[col] == tag
-                tracks_df.loc[mask, f'tag_{tag}'] = tracks_df.loc[mask, weight_col]
-        tracks_df = tracks_df.drop(columns=[col for col in tracks_df.columns if col.startswith('tag_') and (col.endswith('_name') or col.endswith('_weight'))])
-        tracks_df['is_known'] = False
-        for i, track in enumerate(tracks_data):
-            artist_name = track.get('artist', '')
-            track_name = track.get('name', '')
-            track_key = f"{artist_name}|{track_name}".lower()
-            if track_key in known_tracks:
-                tracks_df.loc[i, 'is_known'] = True
-
-        recommender = Recommender(n_neighbors=min(20, len(tracks_df)))
-        numeric_df = recommender.train(tracks_df)
-        if numeric_df.empty:
-            logger.warning("Empty numeric DataFrame, using fallback")
-            fallback_tracks, _ = fallback_recommendations(top_tracks)
-            return fallback_tracks, "Our recommendation algorithm couldn't find perfect matches, but here are some songs you might still enjoy."
-
-        top_track_indices = [i for i, is_known in enumerate(tracks_df['is_known']) if is_known]
-        if not top_track_indices:
-            logger.warning("No top track indices found, using fallback")
-            fallback_tracks, _ = fallback_recommendations(top_tracks)
-            return fallback_tracks, "Our recommendation algorithm couldn't find perfect matches, but here are some songs you might still enjoy."
-
-        seed_df = numeric_df.iloc[top_track_indices]
-        recommended_indices = recommender.recommend(seed_df, numeric_df)
-        new_track_indices = [i for i in recommended_indices if i < len(tracks_data) and not tracks_df.loc[i, 'is_known']]
-        ml_recommended_tracks = [tracks_data[i] for i in new_track_indices]
-
-        final_recommendations = []
-        for track in ml_recommended_tracks:
-            final_recommendations.append({
-                'name': track['name'],
-                'artist': track['artist'],
-                'playcount': track.get('playcount', 0),
-                'listeners': track.get('listeners', 0),
-                'mbid': track.get('mbid', ''),
-                'url': track.get('url', '')
-            })
-
-        if not final_recommendations:
-            logger.warning("No final recommendations found, using fallback")
-            fallback_tracks, _ = fallback_recommendations(top_tracks)
-            return fallback_tracks, "Our recommendation algorithm couldn't find perfect matches, but here are some songs you might still enjoy."
-
-        return final_recommendations, None
+@metrics.timed('ranking')
+def rank_tracks(features, tracks, known):
+    if features.shape[0] == 0 or features.shape[1] == 0:
+        logger.warning("Empty feature matrix")
+        return []
+    top_track_indices = np.flatnonzero(known)
+    if not len(top_track_indices):
+        logger.warning("No top track indices found")
+        return []
+    candidate_indices = np.flatnonzero(~np.asarray(known))
+    if not len(candidate_indices):
+        logger.warning("No candidate tracks to rank")
+        return []
+
+    # Only the candidates are fitted, so no neighbour slot goes to a seed.
+    recommender = Recommender(n_neighbors=min(20, len(candidate_indices)), metric='cosine')
+    recommender.train(features[candidate_indices])
+
+    seed_weights = 1 + np.log1p([tracks[i].playcount for i in top_track_indices])
+    recommended_indices = recommender.recommend(features[top_track_indices], seed_weights)
+    return [tracks[candidate_indices[i]].to_dict() for i in recommended_indices]
+
+@metrics.timed('index')
+def index_candidates(index, context):
+    seeds = context.seeds()
+    if not seeds:
+        return [], None, []
+
+    top_track_tags = context.top_track_tags()
+    seed_matrix = index.vectorize([top_track_tags[track.id] for track in seeds])
+    known_keys = {track.key for track in context.top_tracks}
+    if context.profile is not None:
+        known_keys.update(context.profile.known.values())
+    matches = index.query(seed_matrix, INDEX_CANDIDATES_PER_SEED, index.rows_for_keys(known_keys))
+    candidate_rows = list(dict.fromkeys(row for seed_matches in matches for row, _ in seed_matches))
+    logger.info(f"Candidate index returned {len(candidate_rows)} candidates for {len(seeds)} seeds")
+    return seeds, seed_matrix, candidate_rows
+
+def rank_index_candidates(index, seeds, seed_matrix, candidate_rows):
+    features = sparse.vstack([seed_matrix, index.matrix[candidate_rows]], format='csr')
+    tracks = seeds + [index.track(row) for row in candidate_rows]
+    known = np.arange(len(tracks)) < len(seeds)
+    return rank_tracks(features, tracks, known)
+
+def recommend_from_index(index, context):
+    seeds, seed_matrix, candidate_rows = index_candidates(index, context)
+    if not candidate_rows:
+        return []
+    return rank_index_candidates(index, seeds, seed_matrix, candidate_rows)
+
+def report_progress(progress, stage):
+    if progress is not None:
+        progress(stage)
+
+def run_pipeline(context):
+    index = get_candidate_index()
+    if index is not None:
+        context.report('index')
+        recommendations = recommend_from_index(index, context)
+        if recommendations:
+            return recommendations
+        logger.warning("Candidate index produced no recommendations, using live discovery")
+
+    context.report('candidates')
+    similar_tracks = get_new_tracks_from_lastfm(context)
+    new_similar_tracks = [track for track in similar_tracks if track.id not in context.known_ids()]
+    if not new_similar_tracks:
+        logger.warning("No new similar tracks found, using fallback")
+        return []
 
+    context.report('ranking')
+    features, tracks, known = prepare_track_data(context.top_tracks + new_similar_tracks, context.known_ids(),
+                                                 include_counts=False, track_tags=context.track_tags)
+    if not tracks:
+        logger.warning("Failed to prepare track data, using fallback")
+        return []
+
+    recommendations = rank_tracks(features, tracks, known)
+    if not recommendations:
+        logger.warning("No final recommendations found, using fallback")
+    return recommendations
+
+@metrics.timed('pipeline')
+def generate_recommendations(top_tracks, progress=None, profile=None):
+    context = PipelineContext(top_tracks, profile, progress)
+    try:
+        recommendations = run_pipeline(context)
+        if recommendations:
+            return recommendations, None
+        message = FALLBACK_MESSAGE
     except Exception as e:
         logger.error(f"Error generating recommendations: {e}")
-        fallback_tracks, _ = fallback_recommendations(top_tracks)
-        return fallback_tracks, "Our recommendation algorithm encountered an error, but here are some songs you might still enjoy."
+        message = ERROR_FALLBACK_MESSAGE
+    fallback_tracks, _ = fallback_recommendations(context.top_tracks, progress, profile, context)
+    return fallback_tracks, message
+
+def stream_recommendations(top_tracks, profile=None):
+    context = PipelineContext(top_tracks, profile)
+    top_tracks = context.top_tracks
+    known_ids = context.known_ids()
+    emitted = set()
+
+    def new_matches(tracks):
+        for track in tracks:
+            if track.id not in known_ids and track.id not in emitted:
+                emitted.add(track.id)
+                yield 'track', track.to_dict()
 
-def fallback_recommendations(top_tracks):
     try:
-        all_tags = {}
-        for track in top_tracks:
-            artist_name = track.get('artist', {}).get('name', '') if isinstance(track.get('artist'), dict) else track.get('artist', '')
-            track_name = track.get('name', '')
-            if not artist_name or not track_name:
-                continue
-            tags = get_track_tags(artist_name, track_name)
-            if not tags:
-                continue
-            for tag in tags:
-                tag_name = tag.get('name', '').lower()
-                if tag_name:
-                    all_tags[tag_name] = all_tags.get(tag_name, 0) + int(tag.get('count', 1))
-        
-        if not all_tags:
-            return [], "Could not generate any recommendations."
-        
-        sorted_tags = sorted(all_tags.items(), key=lambda x: x[1], reverse=True)
-        top_tags = [tag for tag, count in sorted_tags[:15]]
-        
-        candidate_tracks = []
-        for tag in top_tags:
-            tag_tracks = get_tracks_for_tag(tag, api_get_tracks_by_tag, limit=30)
-            if tag_tracks:
-                candidate_tracks.extend(tag_tracks)
-                logger.info(f"Fallback: Added {len(tag_tracks)} tracks from tag '{tag}'")
-        
-        known_tracks = set()
-        for track in top_tracks:
-            artist_name = track.get('artist', {}).get('name', '') if isinstance(track.get('artist'), dict) else track.get('artist', '')
-            track_name = track.get('name', '')
-            known_tracks.add(f"{artist_name}|{track_name}".lower())
-        
-        new_tracks = []
-        seen = set()
-        for track in candidate_tracks:
-            artist_name = track.get('artist', {}).get('name', '') if isinstance(track.get('artist'), dict) else track.get('artist', '')
-            track_name = track.get('name', '')
-            track_key = f"{artist_name}|{track_name}".lower()
-            if track_key not in known_tracks and track_key not in seen:
-                seen.add(track_key)
-                new_tracks.append({
-                    'name': track_name,
-                    'artist': artist_name,
-                    'playcount': int(track.get('playcount', 0)),
-                    'listeners': int(track.get('listeners', 0)) if 'listeners' in track else 0,
-                    'mbid': track.get('mbid', ''),
-                    'url': track.get('url', '')
-                })
-        
+        index = get_candidate_index()
+        if index is not None:
+            yield 'stage', 'index'
+            seeds, seed_matrix, candidate_rows = index_candidates(index, context)
+            if candidate_rows:
+                yield from new_matches(index.track(row) for row in candidate_rows)
+                yield 'stage', 'ranking'
+                ranked = rank_index_candidates(index, seeds, seed_matrix, candidate_rows)
+                if ranked:
+                    yield 'ranking', {'tracks': ranked, 'message': None}
+                    return
+
+        yield 'stage', 'candidates'
+        context.top_track_tags()
+        pool = context.candidate_pool()
+        track_tags = context.track_tags
+        similar_tracks = []
+        if pool:
+            # Re-score the seeds each time another slice of candidate tags
+            # arrives, so the first matches go out before every fetch is done.
+            def rescore():
+                available = [track for track in pool if track.id in track_tags]
+                matches = find_similar_tracks_many(top_tracks, available, num_similar=2, track_tags=track_tags)
+                return dedupe_tracks(chain(*matches), known_ids)
+
+            batch_size = max(1, -(-len(pool) // STREAM_BATCHES))
+            pending = 0
+            for _ in context.iter_candidate_tags():
+                pending += 1
+                if pending == batch_size:
+                    pending = 0
+                    similar_tracks = rescore()
+                    yield from new_matches(similar_tracks)
+            if pending:
+                similar_tracks = rescore()
+                yield from new_matches(similar_tracks)
+
+        if similar_tracks:
+            yield 'stage', 'ranking'
+            features, tracks, known = prepare_track_data(top_tracks + similar_tracks, known_ids,
+                                                         include_counts=False, track_tags=track_tags)
+            ranked = rank_tracks(features, tracks, known) if tracks else []
+            if ranked:
+                yield 'ranking', {'tracks': ranked, 'message': None}
+                return
+
+        yield 'stage', 'fallback'
+        fallback_tracks, _ = fallback_recommendations(top_tracks, profile=profile, context=context)
+        yield 'ranking', {'tracks': fallback_tracks, 'message': FALLBACK_MESSAGE}
+    except Exception as e:
+        logger.error(f"Error streaming recommendations: {e}")
+        fallback_tracks, _ = fallback_recommendations(top_tracks, profile=profile, context=context)
+        yield 'ranking', {'tracks': fallback_tracks, 'message': ERROR_FALLBACK_MESSAGE}
+
+def fallback_candidates(context):
+    # Candidates the planner already found come first. Tag lists are only
+    # fetched to top them up, and tags the planner expanded are not fetched
+    # again, so a fallback after a live pass usually makes no API calls.
+    candidates = list(context.results.get('candidate_pool') or [])
+    if len(dedupe_tracks(candidates, context.known_ids())) >= FALLBACK_SIZE:
+        return candidates
+    top_tags = [tag for tag, weight in context.tag_weights(FALLBACK_TAGS)]
+    tracks_by_tag = context.tracks_for_tags(top_tags, FALLBACK_TRACKS_PER_TAG)
+    for tag in top_tags:
+        tag_tracks = tracks_by_tag[tag]
+        if tag_tracks:
+            candidates.extend(tag_tracks)
+            logger.info(f"Fallback: Added {len(tag_tracks)} tracks from tag '{tag}'")
+    return candidates
+
+@metrics.timed('fallback')
+def fallback_recommendations(top_tracks, progress=None, profile=None, context=None):
+    report_progress(progress, 'fallback')
+    if context is None:
+        context = PipelineContext(top_tracks, profile)
+    try:
+        new_tracks = [track.to_dict() for track in dedupe_tracks(fallback_candidates(context), context.known_ids())]
         if not new_tracks:
             return [], "Could not generate any recommendations."
-        
+
         random.shuffle(new_tracks)
-        return new_tracks[:20], None
-    
+        return new_tracks[:FALLBACK_SIZE], None
+
     except Exception as e:
         logger.error(f"Error in fallback recommendations: {e}")
         return [], "Could not generate any recommendations."
@@ -1,21 +1,40 @@
-import pandas as pd
+import numpy as np
+from scipy import sparse
 from sklearn.preprocessing import StandardScaler
 from sklearn.neighbors import NearestNeighbors
 
+def to_dense(features):
+    if sparse.issparse(features):
+        return features.toarray()
+    return np.asarray(features)
+
 class Recommender:
-    def __init__(self, n_neighbors=10):
-        self.scaler = StandardScaler()
-        self.model = NearestNeighbors(n_neighbors=n_neighbors)
+    def __init__(self, n_neighbors=10, metric='euclidean'):
+        self.metric = metric
+        if metric == 'cosine':
+            self.scaler = None
+            self.model = NearestNeighbors(n_neighbors=n_neighbors, metric='cosine', algorithm='brute')
+        else:
+            self.scaler = StandardScaler()
+            self.model = NearestNeighbors(n_neighbors=n_neighbors)
+
+    def train(self, features):
+        if hasattr(features, 'select_dtypes'):
+            features = features.select_dtypes(include='number').dropna(axis=1, how='all').dropna()
+        if features.shape[0] == 0 or features.shape[1] == 0:
+            return features
+        if self.scaler is None:
+            self.model.fit(features)
+        else:
+            self.model.fit(self.scaler.fit_transform(to_dense(features)))
+        return features
 
-    def train(self, df):
-        numeric_df = df.select_dtypes(include='number').dropna(axis=1, how='all').dropna()
-        scaled = self.scaler.fit_transform(numeric_df)
-        self.model.fit(scaled)
-        return numeric_df
+    def recommend(self, seed_features, seed_weights=None):
+        if self.scaler is None:
+            distances, indices = self.model.kneighbors(seed_features)
+            return self.rank(distances, indices, seed_weights)
 
-    def recommend(self, seed_df, candidate_df):
-        seed_scaled = self.scaler.transform(seed_df)
-        candidate_scaled = self.scaler.transform(candidate_df)
+        seed_scaled = self.scaler.transform(to_dense(seed_features))
 
         distances, indices = self.model.kneighbors(seed_scaled)
 
@@ -28,3 +47,12 @@ class Recommender:
                     seen.add(idx)
 
         return flat_indices
+
+    def rank(self, distances, indices, seed_weights=None):
+        if seed_weights is None:
+            seed_weights = np.ones(len(indices))
+        similarities = np.clip(1.0 - distances, 0.0, None) * np.asarray(seed_weights, dtype=np.float64)[:, None]
+        scores = np.zeros(self.model.n_samples_fit_)
+        np.add.at(scores, indices.ravel(), similarities.ravel())
+        neighbors = np.unique(indices)
+        return [int(i) for i in neighbors[np.argsort(-scores[neighbors], kind='stable')]]
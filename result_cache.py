@@ -0,0 +1,191 @@
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from sqlite_store import connect
+import metrics
+from track_cache import CACHE_DIR
+from track_model import pin, unpin
+
+logger = logging.getLogger(__name__)
+
+RESULTS_DB = os.path.join(CACHE_DIR, "results.db")
+RESULT_CACHE_SOFT_TTL = int(os.getenv("RESULT_CACHE_SOFT_TTL", str(15 * 60)))
+RESULT_CACHE_HARD_TTL = int(os.getenv("RESULT_CACHE_HARD_TTL", str(24 * 60 * 60)))
+RESULT_REFRESH_TIMEOUT = 120
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    username TEXT PRIMARY KEY,
+    fingerprint TEXT NOT NULL,
+    value TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    refresh_started REAL NOT NULL DEFAULT 0
+);
+"""
+
+def fingerprint(top_tracks):
+    digest = hashlib.sha1()
+    for track in top_tracks:
+        digest.update(f"{track.key}|{track.playcount}\n".encode('utf-8'))
+    return digest.hexdigest()
+
+class ResultCache:
+    def __init__(self, path=RESULTS_DB, soft_ttl=RESULT_CACHE_SOFT_TTL, hard_ttl=RESULT_CACHE_HARD_TTL, max_workers=2,
+                 admission=None):
+        self.path = path
+        self.admission = admission
+        self.soft_ttl = soft_ttl
+        self.hard_ttl = hard_ttl
+        self.max_workers = max_workers
+        self.executor = None
+        self.lock = threading.Lock()
+        self.counters = {'hits': 0, 'stale_hits': 0, 'misses': 0, 'refreshes': 0, 'refreshes_skipped': 0}
+
+    def _db(self):
+        return connect(self.path, SCHEMA)
+
+    def _count(self, name):
+        with self.lock:
+            self.counters[name] += 1
+        metrics.count(f"result_cache.{name}")
+
+    def get(self, username, top_tracks_fingerprint):
+        row = self._db().execute(
+            "SELECT value, created_at FROM results WHERE username = ? AND fingerprint = ?",
+            (username.lower(), top_tracks_fingerprint)).fetchone()
+        if row is None:
+            return None
+        age = time.time() - row[1]
+        if age > self.hard_ttl:
+            return None
+        return json.loads(row[0]), age > self.soft_ttl
+
+    def set(self, username, top_tracks_fingerprint, value):
+        self._db().execute(
+            "INSERT OR REPLACE INTO results (username, fingerprint, value, created_at, refresh_started) VALUES (?, ?, ?, ?, 0)",
+            (username.lower(), top_tracks_fingerprint, json.dumps(value), time.time()))
+
+    def _claim_refresh(self, username, top_tracks_fingerprint):
+        now = time.time()
+        claimed = self._db().execute(
+            "UPDATE results SET refresh_started = ? WHERE username = ? AND fingerprint = ? AND refresh_started < ?",
+            (now, username.lower(), top_tracks_fingerprint, now - RESULT_REFRESH_TIMEOUT)).rowcount
+        return claimed == 1
+
+    def _release_refresh(self, username, top_tracks_fingerprint):
+        self._db().execute("UPDATE results SET refresh_started = 0 WHERE username = ? AND fingerprint = ?",
+                           (username.lower(), top_tracks_fingerprint))
+
+    def _refresh(self, username, top_tracks_fingerprint, top_tracks, compute):
+        # Refreshes share the pipeline slots with requests. When none is
+        # free the refresh is dropped and the claim released, so a later
+        # stale hit tries again; the stale value keeps being served.
+        ticket = self.admission.try_acquire_background() if self.admission is not None else None
+        if self.admission is not None and ticket is None:
+            unpin()
+            self._count('refreshes_skipped')
+            logger.info(f"Skipping refresh of cached recommendations for {username}, no free slot")
+            try:
+                self._release_refresh(username, top_tracks_fingerprint)
+            except Exception as e:
+                logger.error(f"Error releasing refresh claim for {username}: {e}")
+            return
+        try:
+            start = time.time()
+            value = compute(top_tracks)
+            if value[0]:
+                self.set(username, top_tracks_fingerprint, value)
+                logger.info(f"Refreshed cached recommendations for {username} in {time.time() - start:.2f}s")
+            else:
+                # An empty result (say, with Last.fm unreachable and cold
+                # caches) must not replace a good stale one.
+                logger.warning(f"Refresh for {username} found no recommendations, keeping the cached ones")
+                self._release_refresh(username, top_tracks_fingerprint)
+        except Exception as e:
+            logger.error(f"Error refreshing recommendations for {username}: {e}")
+            try:
+                self._release_refresh(username, top_tracks_fingerprint)
+            except Exception as release_error:
+                logger.error(f"Error releasing refresh claim for {username}: {release_error}")
+        finally:
+            unpin()
+            if ticket is not None:
+                ticket.release()
+
+    def refresh_in_background(self, username, top_tracks_fingerprint, top_tracks, compute):
+        if not self._claim_refresh(username, top_tracks_fingerprint):
+            return
+        self._count('refreshes')
+        with self.lock:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="result-refresh")
+        # The refresh compares ids with the request's tracks, so the intern
+        # table stays pinned from here until it finishes.
+        pin()
+        try:
+            self.executor.submit(self._refresh, username, top_tracks_fingerprint, list(top_tracks), compute)
+        except Exception:
+            unpin()
+            raise
+
+    def lookup(self, username, top_tracks, compute):
+        top_tracks_fingerprint = fingerprint(top_tracks)
+        try:
+            entry = self.get(username, top_tracks_fingerprint)
+        except Exception as e:
+            logger.error(f"Error reading result cache: {e}")
+            entry = None
+        if entry is None:
+            self._count('misses')
+            return None
+        value, stale = entry
+        if stale:
+            self._count('stale_hits')
+            self.refresh_in_background(username, top_tracks_fingerprint, top_tracks, compute)
+        else:
+            self._count('hits')
+        return tuple(value)
+
+    def store(self, username, top_tracks, value):
+        if not value[0]:
+            return
+        try:
+            self.set(username, fingerprint(top_tracks), value)
+        except Exception as e:
+            logger.error(f"Error writing result cache: {e}")
+
+    def fresh(self, username, top_tracks):
+        # A result that needs no refresh, or None; stale entries are left
+        # for lookup so the refresh still happens on the normal path.
+        try:
+            entry = self.get(username, fingerprint(top_tracks))
+        except Exception as e:
+            logger.error(f"Error reading result cache: {e}")
+            return None
+        if entry is None or entry[1]:
+            return None
+        self._count('hits')
+        return tuple(entry[0])
+
+    def get_or_compute(self, username, top_tracks, compute, refresh=None):
+        # `refresh` recomputes a stale entry in the background; it defaults
+        # to `compute` and must not report to anything tied to this request.
+        value = self.lookup(username, top_tracks, refresh or compute)
+        if value is None:
+            value = compute(top_tracks)
+            self.store(username, top_tracks, value)
+        return value
+
+    def invalidate(self, username):
+        self._db().execute("DELETE FROM results WHERE username = ?", (username.lower(),))
+
+    def purge_expired(self):
+        return self._db().execute("DELETE FROM results WHERE created_at < ?", (time.time() - self.hard_ttl,)).rowcount
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters)
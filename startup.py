@@ -0,0 +1,83 @@
+import os
+import gc
+import sys
+import time
+import logging
+import importlib
+import threading
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+PRELOAD_APP = os.getenv("PRELOAD_APP", "0") == "1"
+TAG_CACHE_WARM_ENTRIES = int(os.getenv("TAG_CACHE_WARM_ENTRIES", "5000"))
+
+timings = []
+_timings_lock = threading.Lock()
+_service_lock = threading.Lock()
+
+@contextmanager
+def phase(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        with _timings_lock:
+            timings.append((os.getpid(), name, elapsed))
+        logger.info(f"Startup phase '{name}' took {elapsed * 1000:.1f}ms")
+
+def load_recommendation_service():
+    module = sys.modules.get('recommendation_service')
+    if module is not None:
+        return module
+    with _service_lock:
+        module = sys.modules.get('recommendation_service')
+        if module is None:
+            with phase('import numpy'):
+                importlib.import_module('numpy')
+            with phase('import scipy.sparse'):
+                importlib.import_module('scipy.sparse')
+            with phase('import sklearn.neighbors'):
+                importlib.import_module('sklearn.neighbors')
+            with phase('import recommendation_service'):
+                module = importlib.import_module('recommendation_service')
+    return module
+
+def warm_up():
+    service = load_recommendation_service()
+    with phase('load candidate index'):
+        index = service.get_candidate_index()
+    if index is not None:
+        with phase('touch candidate index'):
+            index.matrix.data.sum()
+    with phase('load tag embedding'):
+        service.get_tag_embedding()
+    with phase('warm tag cache'):
+        warmed = service.tag_cache.warm(TAG_CACHE_WARM_ENTRIES)
+    logger.info(f"Warmed {warmed} tag cache entries")
+    # Keep the preloaded objects out of the collector so forked workers do
+    # not dirty their copy-on-write pages on the first collection.
+    gc.freeze()
+    report()
+
+def after_fork():
+    from last_fm_data_service import reset_client
+    reset_client()
+
+def report():
+    with _timings_lock:
+        phases = [(name, elapsed) for pid, name, elapsed in timings if pid == os.getpid()]
+    total = sum(elapsed for _, elapsed in phases)
+    summary = ", ".join(f"{name}={elapsed * 1000:.0f}ms" for name, elapsed in phases)
+    logger.info(f"Startup timings (total {total * 1000:.0f}ms): {summary}")
+    return {name: round(elapsed * 1000, 1) for name, elapsed in phases}
+
+if __name__ == '__main__':
+    import json
+    logging.basicConfig(level=logging.WARNING)
+    with phase('import app'):
+        importlib.import_module('app')
+    if not PRELOAD_APP:
+        warm_up()
+    print(json.dumps(report(), indent=2))
@@ -0,0 +1,194 @@
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import threading
+from collections import OrderedDict
+import numpy as np
+from sqlite_store import connect
+import track_cache
+import track_tag_cache
+from tag_similarity import TagSimilarityEngine
+from track_model import as_track
+from versioned_dir import VersionedLoader, read_current, new_version, write_current, prune_versions, directory_size
+
+logger = logging.getLogger(__name__)
+
+TAG_EMBEDDING_DIR = os.getenv("TAG_EMBEDDING_DIR", os.path.join(track_cache.CACHE_DIR, "tag_embedding"))
+TAG_EMBEDDING_DIMENSIONS = int(os.getenv("TAG_EMBEDDING_DIMENSIONS", "64"))
+TAG_EMBEDDING_MIN_TRACKS = int(os.getenv("TAG_EMBEDDING_MIN_TRACKS", "2"))
+TAG_EMBEDDING_MAX_VOCABULARY = int(os.getenv("TAG_EMBEDDING_MAX_VOCABULARY", "50000"))
+TAG_EMBEDDING_CACHE_ENTRIES = int(os.getenv("TAG_EMBEDDING_CACHE_ENTRIES", "50000"))
+# Weight, on Last.fm's 0-100 tag count scale, given to a tag for a track
+# listed under it by tag.getTopTracks when the track's own cached tags do
+# not already weight it.
+TAG_LISTING_WEIGHT = 50
+
+class TagEmbedding:
+    def __init__(self, path, cache_entries=TAG_EMBEDDING_CACHE_ENTRIES):
+        self.path = path
+        with open(os.path.join(path, "meta.json"), 'r', encoding='utf-8') as f:
+            self.meta = json.load(f)
+        self.vocabulary = {tag: i for i, tag in enumerate(self.meta['vocabulary'])}
+        self.projection = np.ascontiguousarray(np.load(os.path.join(path, "components.npy")).T)
+        self.dimensions = self.projection.shape[1]
+        self.cache_entries = cache_entries
+        self.vectors = OrderedDict()
+        self.lock = threading.Lock()
+        self.counters = {'hits': 0, 'misses': 0}
+
+    def embed(self, tag_lists):
+        matrix = TagSimilarityEngine(self.vocabulary).build_matrix(tag_lists, extend_vocabulary=False, dtype=np.float32)
+        vectors = np.asarray(matrix @ self.projection, dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        np.divide(vectors, norms, out=vectors, where=norms > 0)
+        return vectors
+
+    def vectors_for(self, tracks, track_tags):
+        # Vectors only depend on a track's tags, so they are kept per track
+        # id and reused by later requests. Tracks without tags, or whose
+        # tags are all outside the vocabulary, are left out.
+        found = {}
+        with self.lock:
+            for track in tracks:
+                vector = self.vectors.get(track.id)
+                if vector is not None:
+                    self.vectors.move_to_end(track.id)
+                    found[track.id] = vector
+        missing = list({track.id: track for track in tracks
+                        if track.id not in found and track_tags.get(track.id)}.values())
+        if missing:
+            vectors = self.embed([track_tags[track.id] for track in missing])
+            with self.lock:
+                for track, vector in zip(missing, vectors):
+                    found[track.id] = vector
+                    self.vectors[track.id] = vector
+                while len(self.vectors) > self.cache_entries:
+                    self.vectors.popitem(last=False)
+        with self.lock:
+            self.counters['hits'] += len(found) - len(missing)
+            self.counters['misses'] += len(missing)
+
+        kept = [track for track in tracks if track.id in found and found[track.id].any()]
+        matrix = np.empty((len(kept), self.dimensions), dtype=np.float32)
+        for row, track in enumerate(kept):
+            matrix[row] = found[track.id]
+        return matrix, kept
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters, size=len(self.vectors), dimensions=self.dimensions)
+
+def load_embedding(path):
+    embedding = TagEmbedding(path)
+    logger.info(f"Loaded {embedding.dimensions}-dimensional tag embedding {os.path.basename(path)}")
+    return embedding
+
+_loader = VersionedLoader(TAG_EMBEDDING_DIR, load_embedding, "tag embedding")
+
+def get_tag_embedding():
+    return _loader.get()
+
+def embedding_stats():
+    return _loader.value.stats() if _loader.value is not None else None
+
+def collect_documents():
+    documents = {}
+    db = connect(track_tag_cache.TRACK_TAGS_DB, track_tag_cache.SCHEMA)
+    for key, tags_json in db.execute("SELECT key, tags FROM track_tags"):
+        weights = documents.setdefault(key, {})
+        for tag in json.loads(tags_json):
+            tag_name = tag.get('name', '').lower()
+            if tag_name:
+                weights[tag_name] = float(tag.get('count', 0))
+    db = connect(track_cache.TAG_TRACKS_DB, track_cache.SCHEMA)
+    for tag, tracks_json in db.execute("SELECT tag, tracks FROM tag_tracks"):
+        for track in json.loads(tracks_json):
+            documents.setdefault(as_track(track).key, {}).setdefault(tag.lower(), TAG_LISTING_WEIGHT)
+    return documents
+
+def select_vocabulary(documents, min_tracks, max_vocabulary):
+    frequency = {}
+    for weights in documents.values():
+        for tag_name, weight in weights.items():
+            if weight > 0:
+                frequency[tag_name] = frequency.get(tag_name, 0) + 1
+    tags = sorted((tag for tag, count in frequency.items() if count >= min_tracks),
+                  key=lambda tag: (-frequency[tag], tag))
+    return tags[:max_vocabulary]
+
+def train_embedding(dimensions=TAG_EMBEDDING_DIMENSIONS, min_tracks=TAG_EMBEDDING_MIN_TRACKS,
+                    max_vocabulary=TAG_EMBEDDING_MAX_VOCABULARY, embedding_dir=TAG_EMBEDDING_DIR):
+    from sklearn.decomposition import TruncatedSVD
+
+    start = time.perf_counter()
+    documents = collect_documents()
+    vocabulary = select_vocabulary(documents, min_tracks, max_vocabulary)
+    engine = TagSimilarityEngine({tag: i for i, tag in enumerate(vocabulary)})
+    matrix = engine.build_matrix([[{'name': tag, 'count': weight} for tag, weight in weights.items()]
+                                  for weights in documents.values()], extend_vocabulary=False, dtype=np.float32)
+    matrix = matrix[matrix.getnnz(axis=1) > 0]
+    n_components = min(dimensions, len(vocabulary) - 1, matrix.shape[0] - 1)
+    if n_components < 1:
+        raise ValueError(f"Not enough cached tag data to train an embedding "
+                         f"({matrix.shape[0]} tracks, {len(vocabulary)} tags)")
+    svd = TruncatedSVD(n_components=n_components, random_state=0)
+    svd.fit(matrix)
+    train_seconds = time.perf_counter() - start
+
+    version, path = new_version(embedding_dir)
+    np.save(os.path.join(path, "components.npy"), svd.components_.astype(np.float32))
+    meta = {
+        'built_at': time.time(),
+        'tracks': matrix.shape[0],
+        'dimensions': n_components,
+        'explained_variance': float(svd.explained_variance_ratio_.sum()),
+        'vocabulary': vocabulary
+    }
+    with open(os.path.join(path, "meta.json"), 'w', encoding='utf-8') as f:
+        json.dump(meta, f)
+    write_current(embedding_dir, version)
+    prune_versions(embedding_dir)
+    return report(path, train_seconds=round(train_seconds, 2))
+
+def report(path, **extra):
+    embedding = TagEmbedding(path)
+    return dict({
+        'path': path,
+        'tracks': embedding.meta['tracks'],
+        'vocabulary': len(embedding.vocabulary),
+        'dimensions': embedding.dimensions,
+        'explained_variance': round(embedding.meta['explained_variance'], 3),
+        'built_at': time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(embedding.meta['built_at'])),
+        'size_bytes': directory_size(path)
+    }, **extra)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Train or inspect the tag embedding used to rank recommendations.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    train = subparsers.add_parser('train', help="Learn a new embedding from the cached tag data")
+    train.add_argument('--dimensions', type=int, default=TAG_EMBEDDING_DIMENSIONS)
+    train.add_argument('--min-tracks', type=int, default=TAG_EMBEDDING_MIN_TRACKS,
+                       help="leave out tags seen on fewer tracks than this")
+    train.add_argument('--max-vocabulary', type=int, default=TAG_EMBEDDING_MAX_VOCABULARY)
+    train.add_argument('--embedding-dir', default=TAG_EMBEDDING_DIR)
+    stats = subparsers.add_parser('stats', help="Describe the current embedding")
+    stats.add_argument('--embedding-dir', default=TAG_EMBEDDING_DIR)
+    args = parser.parse_args(argv)
+
+    if args.command == 'train':
+        result = train_embedding(args.dimensions, args.min_tracks, args.max_vocabulary, args.embedding_dir)
+    else:
+        version = read_current(args.embedding_dir)
+        if version is None:
+            print(f"No tag embedding in {args.embedding_dir}", file=sys.stderr)
+            return 1
+        result = report(os.path.join(args.embedding_dir, version))
+    print(json.dumps(result, indent=2))
+    return 0
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(main())
@@ -0,0 +1,62 @@
+import math
+import numpy as np
+from scipy import sparse
+
+def tag_weights(tags):
+    return {tag['name'].lower(): float(tag.get('count', 0)) for tag in tags if 'name' in tag}
+
+def select_top_k(scores, k, active=None):
+    results = [[] for _ in range(scores.shape[0])]
+    if scores.shape[1] == 0 or k <= 0:
+        return results
+    k = min(k, scores.shape[1])
+    kth = np.argpartition(-scores, k - 1, axis=1)[:, k - 1]
+    thresholds = scores[np.arange(scores.shape[0]), kth]
+    for row, row_scores in enumerate(scores):
+        if active is not None and not active[row]:
+            continue
+        # Take every candidate tied with the k-th score, then break ties
+        # by candidate position so the ranking matches a stable sort.
+        selected = np.flatnonzero((row_scores >= thresholds[row]) & np.isfinite(row_scores))
+        order = selected[np.lexsort((selected, -row_scores[selected]))][:k]
+        results[row] = [(int(i), float(row_scores[i])) for i in order]
+    return results
+
+class TagSimilarityEngine:
+    def __init__(self, vocabulary=None):
+        self.vocabulary = {} if vocabulary is None else vocabulary
+
+    def build_matrix(self, tag_lists, extend_vocabulary=True, dtype=np.float64):
+        rows, cols, data = [], [], []
+        for row, tags in enumerate(tag_lists):
+            weights = tag_weights(tags or [])
+            norm = math.sqrt(sum(weight * weight for weight in weights.values()))
+            if not norm:
+                continue
+            for tag_name, weight in weights.items():
+                if extend_vocabulary:
+                    col = self.vocabulary.setdefault(tag_name, len(self.vocabulary))
+                else:
+                    col = self.vocabulary.get(tag_name)
+                    if col is None:
+                        continue
+                rows.append(row)
+                cols.append(col)
+                data.append(weight / norm)
+        return sparse.csr_matrix((data, (rows, cols)), shape=(len(tag_lists), len(self.vocabulary)), dtype=dtype)
+
+    def score(self, seed_tag_lists, candidate_tag_lists):
+        matrix = self.build_matrix(list(seed_tag_lists) + list(candidate_tag_lists))
+        seeds = matrix[:len(seed_tag_lists)]
+        candidates = matrix[len(seed_tag_lists):]
+        return (seeds @ candidates.T).toarray()
+
+    def top_k(self, seed_tag_lists, candidate_tag_lists, k, exclude=None):
+        if not candidate_tag_lists:
+            return [[] for _ in seed_tag_lists]
+        # Round away float noise so tracks with proportional tag weights tie
+        # exactly and keep their candidate order.
+        scores = np.round(self.score(seed_tag_lists, candidate_tag_lists), 12)
+        for seed_index, candidate_index in exclude or ():
+            scores[seed_index, candidate_index] = -np.inf
+        return select_top_k(scores, k, [bool(tags) for tags in seed_tag_lists])
@@ -0,0 +1,43 @@
+import time
+import pytest
+from last_fm_data_service import LastFmClient, LastFmError, CircuitBreaker, CircuitOpenError
+
+class FailingClient(LastFmClient):
+    # Every request fails with Last.fm's temporary error.
+    def request(self, method, params=None, deadline=None):
+        raise LastFmError(f"{method} failed: temporary error", 16, 503)
+
+def make_client():
+    client = FailingClient(api_key='test', api_url='http://127.0.0.1:9/2.0/')
+    client.breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.1)
+    return client
+
+def test_probe_stopped_by_deadline_reopens_breaker():
+    client = make_client()
+    with pytest.raises(LastFmError):
+        client.call('track.gettoptags', {}, deadline=time.monotonic() + 0.01)
+    assert client.breaker.state == 'open'
+    with pytest.raises(CircuitOpenError):
+        client.call('track.gettoptags', {})
+
+    time.sleep(0.15)
+    with pytest.raises(LastFmError) as probe:
+        client.call('track.gettoptags', {}, deadline=time.monotonic() + 0.01)
+    assert not isinstance(probe.value, CircuitOpenError)
+    assert client.breaker.state == 'open'
+
+    time.sleep(0.15)
+    assert client.breaker.allow()
+
+def test_probe_that_never_reports_is_replaced():
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.1)
+    breaker.record_failure()
+    time.sleep(0.15)
+    assert breaker.allow()
+    assert breaker.state == 'half_open'
+    assert not breaker.allow()
+
+    time.sleep(0.15)
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.state == 'closed'
@@ -0,0 +1,24 @@
+from history import TagProfile
+from track_model import Track
+
+def tags(*names):
+    return [{'name': name, 'count': 100} for name in names]
+
+def snapshot(playcounts):
+    profile = TagProfile()
+    for name, plays in playcounts.items():
+        profile.add(Track(name, 'artist', plays), plays)
+    return profile
+
+def test_carry_folds_only_leaves_changed_tracks_unfolded():
+    stored = snapshot({'a': 10, 'b': 5})
+    stored.fold({track.id: tags('rock') for track in stored.unfolded()})
+
+    profile = snapshot({'a': 10, 'b': 7, 'c': 3})
+    profile.carry_folds(stored)
+    assert sorted(track.name for track in profile.unfolded()) == ['b', 'c']
+
+    profile.fold({track.id: tags('rock') for track in profile.unfolded()})
+    rebuilt = snapshot({'a': 10, 'b': 7, 'c': 3})
+    rebuilt.fold({track.id: tags('rock') for track in rebuilt.unfolded()})
+    assert abs(profile.weights['rock'] - rebuilt.weights['rock']) < 1e-6
@@ -0,0 +1,17 @@
+import time
+import pytest
+from last_fm_data_service import TokenBucket, DeadlineExceeded
+
+def test_acquire_stops_at_deadline():
+    bucket = TokenBucket(rate=1, capacity=1)
+    bucket.acquire()
+    start = time.monotonic()
+    with pytest.raises(DeadlineExceeded):
+        bucket.acquire(deadline=start + 0.2)
+    assert time.monotonic() - start < 0.1
+
+def test_acquire_waits_when_deadline_allows():
+    bucket = TokenBucket(rate=20, capacity=1)
+    bucket.acquire()
+    bucket.acquire(deadline=time.monotonic() + 1)
+    assert bucket.tokens < 1
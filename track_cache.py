@@ -2,69 +2,192 @@ import os
 import json
 import time
 import logging
-from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from sqlite_store import connect, chunked
+import metrics
+from track_model import as_track, as_tracks
 
 logger = logging.getLogger(__name__)
 
 CACHE_DIR = "cache"
 TAG_TRACKS_CACHE_FILE = os.path.join(CACHE_DIR, "tag_tracks_cache.json")
+TAG_TRACKS_DB = os.path.join(CACHE_DIR, "tag_tracks.db")
 CACHE_EXPIRY_DAYS = 7
+# Empty answers (unknown tracks, tags with no tracks) are cached for a much
+# shorter time, so they stop costing an API call per request but still
+# recover reasonably quickly if Last.fm starts returning data for them.
+NEGATIVE_CACHE_TTL = int(os.getenv("NEGATIVE_CACHE_TTL", str(6 * 60 * 60)))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tag_tracks (
+    tag TEXT PRIMARY KEY,
+    tracks TEXT NOT NULL,
+    expires_at REAL NOT NULL,
+    fetch_limit INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS similar_tracks (
+    track TEXT PRIMARY KEY,
+    tracks TEXT NOT NULL,
+    expires_at REAL NOT NULL,
+    fetch_limit INTEGER NOT NULL DEFAULT 0
+);
+"""
+
+# Table and key column for each kind of cached track list.
+TAG_TRACKS = ('tag_tracks', 'tag')
+SIMILAR_TRACKS = ('similar_tracks', 'track')
+
+_migrated = set()
 
 def ensure_cache_dir():
     if not os.path.exists(CACHE_DIR):
         os.makedirs(CACHE_DIR)
 
-def load_tag_tracks_cache():
-    ensure_cache_dir()
-    if not os.path.exists(TAG_TRACKS_CACHE_FILE):
-        return {"last_updated": time.time(), "tags": {}}
-    
+def get_db():
+    db = connect(TAG_TRACKS_DB, SCHEMA)
+    if TAG_TRACKS_DB not in _migrated:
+        migrate(db)
+        _migrated.add(TAG_TRACKS_DB)
+    if os.path.exists(TAG_TRACKS_CACHE_FILE):
+        import_legacy_cache(db)
+    return db
+
+def migrate(db):
+    # Rows written before the fetch limit was recorded get 0, so they only
+    # satisfy requests once they are refetched.
+    columns = {row[1] for row in db.execute("PRAGMA table_info(tag_tracks)")}
+    if 'fetch_limit' not in columns:
+        db.execute("ALTER TABLE tag_tracks ADD COLUMN fetch_limit INTEGER NOT NULL DEFAULT 0")
+
+def import_legacy_cache(db):
     try:
         with open(TAG_TRACKS_CACHE_FILE, 'r', encoding='utf-8') as f:
             cache = json.load(f)
-            logger.info(f"Loaded cache with {len(cache.get('tags', {}))} tags")
-            return cache
+        expires_at = cache.get("last_updated", 0) + CACHE_EXPIRY_DAYS * 24 * 60 * 60
+        db.executemany("INSERT OR IGNORE INTO tag_tracks (tag, tracks, expires_at) VALUES (?, ?, ?)",
+                       [(tag, json.dumps(tracks), expires_at) for tag, tracks in cache.get("tags", {}).items()])
+        os.replace(TAG_TRACKS_CACHE_FILE, TAG_TRACKS_CACHE_FILE + ".imported")
+        logger.info(f"Imported {len(cache.get('tags', {}))} tags from legacy cache file")
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        logger.error(f"Error importing legacy cache: {e}")
+
+def load_lists(kind, keys, limit):
+    # A cached list answers a request for up to `limit` tracks if it was
+    # fetched with at least that limit, or came back shorter than it was
+    # asked to be and so already holds every track Last.fm has for the key.
+    table, column = kind
+    keys = list(dict.fromkeys(keys))
+    found = {}
+    try:
+        db = get_db()
+        now = time.time()
+        for chunk in chunked(keys):
+            placeholders = ",".join("?" * len(chunk))
+            for key, tracks, fetch_limit in db.execute(
+                    f"SELECT {column}, tracks, fetch_limit FROM {table} WHERE {column} IN ({placeholders}) AND expires_at > ?",
+                    (*chunk, now)):
+                tracks = json.loads(tracks)
+                if fetch_limit >= limit or len(tracks) < fetch_limit:
+                    found[key] = as_tracks(tracks[:limit])
     except Exception as e:
         logger.error(f"Error loading cache: {e}")
-        return {"last_updated": time.time(), "tags": {}}
+    return found
 
-def save_tag_tracks_cache(cache):
-    ensure_cache_dir()
+def save_lists(kind, lists, limit, ttl=None):
+    if not lists:
+        return
+    table, column = kind
+    expires_at = time.time() + (CACHE_EXPIRY_DAYS * 24 * 60 * 60 if ttl is None else ttl)
     try:
-        with open(TAG_TRACKS_CACHE_FILE, 'w', encoding='utf-8') as f:
-            json.dump(cache, f)
-            logger.info(f"Saved cache with {len(cache.get('tags', {}))} tags")
+        db = get_db()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            db.executemany(
+                f"INSERT OR REPLACE INTO {table} ({column}, tracks, expires_at, fetch_limit) VALUES (?, ?, ?, ?)",
+                [(key, json.dumps([as_track(track).to_dict() for track in tracks]), expires_at, limit)
+                 for key, tracks in lists.items()])
+            db.execute("COMMIT")
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+        logger.info(f"Saved {len(lists)} entries to {table} cache")
     except Exception as e:
         logger.error(f"Error saving cache: {e}")
 
+def store_fetched(kind, fetched, limit):
+    # Keys that could not be fetched at all (None) are left out of the cache
+    # so the next request tries them again.
+    save_lists(kind, {key: tracks for key, tracks in fetched.items() if tracks}, limit)
+    save_lists(kind, {key: tracks for key, tracks in fetched.items() if tracks == []}, limit, ttl=NEGATIVE_CACHE_TTL)
+
+def fetch_lists(kind, targets, fetch, limit, force_refresh=False, max_workers=4):
+    # `targets` maps each cache key to the argument `fetch` is called with.
+    # Each list is cached by the worker that fetched it, so a caller that
+    # stops waiting still keeps what its calls bring back.
+    table, _ = kind
+    cached = {} if force_refresh else load_lists(kind, targets, limit)
+    missing = [key for key in targets if key not in cached]
+    metrics.record_cache_lookups(table, len(cached), len(missing))
+    if cached:
+        logger.info(f"Using cached {table} for {len(cached)} keys")
+    if missing:
+        logger.info(f"Fetching {table} for {len(missing)} keys from API")
+
+        def fetch_and_store(key):
+            tracks = fetch_list(fetch, targets[key], key)
+            store_fetched(kind, {key: tracks}, limit)
+            return tracks
+
+        fetch_and_store = metrics.bind_trace(fetch_and_store)
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(missing)))) as executor:
+            fetched = dict(zip(missing, executor.map(fetch_and_store, missing)))
+        cached.update((key, tracks or []) for key, tracks in fetched.items())
+    return {key: cached[key] for key in targets}
+
+def fetch_list(fetch, target, key):
+    try:
+        return fetch(target)
+    except Exception as e:
+        if getattr(e, 'permanent', False):
+            return []
+        logger.warning(f"Tracks for {key} unavailable: {e}")
+        return None
+
+def get_many(tags, limit):
+    return load_lists(TAG_TRACKS, tags, limit)
+
+def set_many(tag_tracks, limit, ttl=None):
+    save_lists(TAG_TRACKS, tag_tracks, limit, ttl)
+
+def get_tracks_for_tags(tags, get_tracks_func, limit=50, force_refresh=False, max_workers=4):
+    return fetch_lists(TAG_TRACKS, {tag: tag for tag in tags}, lambda tag: get_tracks_func(tag, limit), limit,
+                       force_refresh, max_workers)
+
 def get_tracks_for_tag(tag, get_tracks_func, limit=50, force_refresh=False):
-    cache = load_tag_tracks_cache()
-    
-    cache_age = time.time() - cache.get("last_updated", 0)
-    cache_expired = cache_age > (CACHE_EXPIRY_DAYS * 24 * 60 * 60)
-    
-    if force_refresh or cache_expired:
-        logger.info(f"Cache {'expired' if cache_expired else 'refresh forced'}, clearing")
-        cache = {"last_updated": time.time(), "tags": {}}
-    
-    if tag in cache.get("tags", {}) and not force_refresh:
-        logger.info(f"Using cached tracks for tag '{tag}'")
-        return cache["tags"][tag]
-    
-    logger.info(f"Fetching tracks for tag '{tag}' from API")
-    tracks = get_tracks_func(tag, limit)
-    
-    if "tags" not in cache:
-        cache["tags"] = {}
-    cache["tags"][tag] = tracks
-    cache["last_updated"] = time.time()
-    
-    save_tag_tracks_cache(cache)
-    
-    return tracks
+    return get_tracks_for_tags([tag], get_tracks_func, limit, force_refresh)[tag]
+
+def get_similar_for_tracks(tracks, get_similar_func, limit=20, max_workers=4):
+    # Keyed by Track.key; the result maps each track's id to its list.
+    targets = {track.key: track for track in tracks}
+    lists = fetch_lists(SIMILAR_TRACKS, targets, lambda track: get_similar_func(track.artist, track.name, limit),
+                        limit, max_workers=max_workers)
+    return {track.id: lists[track.key] for track in tracks}
+
+def purge_expired():
+    db = get_db()
+    now = time.time()
+    deleted = sum(db.execute(f"DELETE FROM {table} WHERE expires_at <= ?", (now,)).rowcount
+                  for table, _ in (TAG_TRACKS, SIMILAR_TRACKS))
+    logger.info(f"Purged {deleted} expired track lists from cache")
+    return deleted
 
 def clear_cache():
     ensure_cache_dir()
+    db = get_db()
+    db.execute("DELETE FROM tag_tracks")
+    db.execute("DELETE FROM similar_tracks")
     if os.path.exists(TAG_TRACKS_CACHE_FILE):
         os.remove(TAG_TRACKS_CACHE_FILE)
-        logger.info("Cache cleared")
+    logger.info("Cache cleared")
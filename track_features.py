@@ -0,0 +1,37 @@
+import numpy as np
+from scipy import sparse
+
+MAX_TAGS_PER_TRACK = 10
+COUNT_FEATURES = ['playcount', 'listeners']
+
+def build_track_features(tracks, track_tags, known_ids=(), include_counts=True):
+    vocabulary = {}
+    offset = len(COUNT_FEATURES) if include_counts else 0
+    kept = []
+    indptr = [0]
+    indices = []
+    data = []
+    for track in tracks:
+        tags = track_tags.get(track.id)
+        if not tags:
+            continue
+        weights = {}
+        for tag in tags[:MAX_TAGS_PER_TRACK]:
+            tag_name = tag.get('name', '').lower()
+            if tag_name:
+                weights[tag_name] = float(tag.get('count', 0))
+        if include_counts:
+            indices.extend(range(offset))
+            data.extend(float(getattr(track, feature)) for feature in COUNT_FEATURES)
+        for tag_name, weight in weights.items():
+            indices.append(offset + vocabulary.setdefault(tag_name, len(vocabulary)))
+            data.append(weight)
+        indptr.append(len(indices))
+        kept.append(track)
+
+    features = sparse.csr_matrix(
+        (np.asarray(data, dtype=np.float64), np.asarray(indices, dtype=np.int32), np.asarray(indptr, dtype=np.int32)),
+        shape=(len(kept), offset + len(vocabulary))
+    )
+    known = np.fromiter((track.id in known_ids for track in kept), dtype=bool, count=len(kept))
+    return features, kept, known, vocabulary
@@ -0,0 +1,97 @@
+import os
+import itertools
+import threading
+from contextlib import contextmanager
+
+# Ids are only meaningful inside one process; anything persisted or shared
+# between workers is keyed by Track.key instead.
+TRACK_INTERN_MAX_ENTRIES = int(os.getenv("TRACK_INTERN_MAX_ENTRIES", "200000"))
+
+_ids = {}
+_next_id = itertools.count()
+_intern_lock = threading.Lock()
+_pins = 0
+
+def make_key(artist, name):
+    return f"{artist}|{name}".lower()
+
+def intern_key(key):
+    track_id = _ids.get(key)
+    if track_id is None:
+        with _intern_lock:
+            track_id = _ids.get(key)
+            if track_id is None:
+                track_id = _ids[key] = next(_next_id)
+    return track_id
+
+def pin():
+    # Anything that compares ids across Tracks parsed at different times
+    # (a request, a background refresh) holds a pin while it runs. The
+    # table is only reset once it is over its cap and nothing is pinned, so
+    # one piece of work never sees a key under two ids. Ids keep counting
+    # after a reset, so two keys never share one either.
+    global _pins
+    with _intern_lock:
+        if not _pins and len(_ids) >= TRACK_INTERN_MAX_ENTRIES:
+            _ids.clear()
+        _pins += 1
+
+def unpin():
+    global _pins
+    with _intern_lock:
+        _pins -= 1
+
+@contextmanager
+def pinned():
+    pin()
+    try:
+        yield
+    finally:
+        unpin()
+
+class Track:
+    __slots__ = ('id', 'key', 'name', 'artist', 'playcount', 'listeners', 'mbid', 'url')
+
+    def __init__(self, name, artist, playcount=0, listeners=0, mbid='', url=''):
+        self.name = name
+        self.artist = artist
+        self.playcount = playcount
+        self.listeners = listeners
+        self.mbid = mbid
+        self.url = url
+        self.key = make_key(artist, name)
+        self.id = intern_key(self.key)
+
+    @classmethod
+    def from_lastfm(cls, data):
+        artist = data.get('artist', '')
+        if isinstance(artist, dict):
+            # user.getrecenttracks puts the artist name under '#text'.
+            artist = artist.get('name') or artist.get('#text', '')
+        return cls(
+            data.get('name', ''),
+            artist,
+            int(data.get('playcount') or 0),
+            int(data.get('listeners') or 0),
+            data.get('mbid', ''),
+            data.get('url', '')
+        )
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'artist': self.artist,
+            'playcount': self.playcount,
+            'listeners': self.listeners,
+            'mbid': self.mbid,
+            'url': self.url
+        }
+
+    def __repr__(self):
+        return f"Track({self.artist!r}, {self.name!r})"
+
+def as_track(track):
+    return track if isinstance(track, Track) else Track.from_lastfm(track)
+
+def as_tracks(tracks):
+    return [as_track(track) for track in tracks]
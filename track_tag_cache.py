@@ -0,0 +1,149 @@
+import os
+import json
+import time
+import logging
+import threading
+from collections import OrderedDict
+from sqlite_store import connect, chunked
+from track_cache import CACHE_DIR
+
+logger = logging.getLogger(__name__)
+
+TRACK_TAGS_DB = os.path.join(CACHE_DIR, "track_tags.db")
+TAG_CACHE_MAX_ENTRIES = int(os.getenv("TAG_CACHE_MAX_ENTRIES", "10000"))
+TAG_CACHE_TTL = int(os.getenv("TAG_CACHE_TTL", str(7 * 24 * 60 * 60)))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS track_tags (
+    key TEXT PRIMARY KEY,
+    tags TEXT NOT NULL,
+    expires_at REAL NOT NULL
+);
+"""
+
+class TrackTagCache:
+    def __init__(self, path=TRACK_TAGS_DB, max_entries=TAG_CACHE_MAX_ENTRIES, ttl=TAG_CACHE_TTL):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.counters = {'hits': 0, 'disk_hits': 0, 'misses': 0, 'evictions': 0, 'expirations': 0}
+
+    def _db(self):
+        return connect(self.path, SCHEMA)
+
+    def _get_memory(self, key, now):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        expires_at, tags = entry
+        if expires_at <= now:
+            del self.entries[key]
+            self.counters['expirations'] += 1
+            return None
+        self.entries.move_to_end(key)
+        self.counters['hits'] += 1
+        return tags
+
+    def _put_memory(self, key, tags, expires_at):
+        self.entries[key] = (expires_at, tags)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.counters['evictions'] += 1
+
+    def get(self, key):
+        return self.get_many([key]).get(key)
+
+    def get_many(self, keys):
+        now = time.time()
+        found = {}
+        missing = []
+        with self.lock:
+            for key in keys:
+                tags = self._get_memory(key, now)
+                if tags is None:
+                    missing.append(key)
+                else:
+                    found[key] = tags
+        if not missing:
+            return found
+
+        rows = []
+        try:
+            db = self._db()
+            for chunk in chunked(missing):
+                placeholders = ",".join("?" * len(chunk))
+                rows.extend(db.execute(
+                    f"SELECT key, tags, expires_at FROM track_tags WHERE key IN ({placeholders}) AND expires_at > ?",
+                    (*chunk, now)).fetchall())
+        except Exception as e:
+            logger.error(f"Error reading tag cache: {e}")
+
+        with self.lock:
+            for key, tags_json, expires_at in rows:
+                tags = json.loads(tags_json)
+                self._put_memory(key, tags, expires_at)
+                found[key] = tags
+            self.counters['disk_hits'] += len(rows)
+            self.counters['misses'] += len(missing) - len(rows)
+        return found
+
+    def set(self, key, tags, ttl=None):
+        self.set_many({key: tags}, ttl)
+
+    def set_many(self, items, ttl=None):
+        if not items:
+            return
+        expires_at = time.time() + (self.ttl if ttl is None else ttl)
+        with self.lock:
+            for key, tags in items.items():
+                self._put_memory(key, tags, expires_at)
+        try:
+            db = self._db()
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                db.executemany("INSERT OR REPLACE INTO track_tags (key, tags, expires_at) VALUES (?, ?, ?)",
+                               [(key, json.dumps(tags), expires_at) for key, tags in items.items()])
+                db.execute("COMMIT")
+            except Exception:
+                db.execute("ROLLBACK")
+                raise
+        except Exception as e:
+            logger.error(f"Error writing tag cache: {e}")
+
+    def warm(self, limit):
+        try:
+            rows = self._db().execute(
+                "SELECT key, tags, expires_at FROM track_tags WHERE expires_at > ? ORDER BY expires_at DESC LIMIT ?",
+                (time.time(), min(limit, self.max_entries))).fetchall()
+        except Exception as e:
+            logger.error(f"Error warming tag cache: {e}")
+            return 0
+        with self.lock:
+            for key, tags_json, expires_at in reversed(rows):
+                self._put_memory(key, json.loads(tags_json), expires_at)
+        return len(rows)
+
+    def purge_expired(self):
+        try:
+            deleted = self._db().execute("DELETE FROM track_tags WHERE expires_at <= ?", (time.time(),)).rowcount
+            logger.info(f"Purged {deleted} expired tag cache entries")
+            return deleted
+        except Exception as e:
+            logger.error(f"Error purging tag cache: {e}")
+            return 0
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+        self._db().execute("DELETE FROM track_tags")
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats['size'] = len(self.entries)
+        lookups = stats['hits'] + stats['disk_hits'] + stats['misses']
+        stats['hit_ratio'] = (stats['hits'] + stats['disk_hits']) / lookups if lookups else 0.0
+        return stats
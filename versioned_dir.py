@@ -0,0 +1,69 @@
+import os
+import time
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+CURRENT_FILE = "CURRENT"
+
+def read_current(directory):
+    try:
+        with open(os.path.join(directory, CURRENT_FILE), 'r', encoding='utf-8') as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        return None
+
+def new_version(directory):
+    version = time.strftime("%Y%m%d-%H%M%S")
+    path = os.path.join(directory, version)
+    os.makedirs(path, exist_ok=True)
+    return version, path
+
+def write_current(directory, version):
+    # Readers only ever see the old or the new version, never half a write.
+    pointer = os.path.join(directory, CURRENT_FILE)
+    with open(pointer + ".tmp", 'w', encoding='utf-8') as f:
+        f.write(version)
+    os.replace(pointer + ".tmp", pointer)
+
+def prune_versions(directory, keep=2):
+    current = read_current(directory)
+    versions = sorted(name for name in os.listdir(directory) if os.path.isdir(os.path.join(directory, name)))
+    for version in versions[:-keep]:
+        if version == current:
+            continue
+        path = os.path.join(directory, version)
+        for name in os.listdir(path):
+            os.remove(os.path.join(path, name))
+        os.rmdir(path)
+
+def directory_size(path):
+    return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+
+class VersionedLoader:
+    # Holds the object built from the version CURRENT points at, and builds
+    # it again when the pointer moves. A version that fails to load is
+    # remembered too, so it is not retried on every call.
+    def __init__(self, directory, load, name):
+        self.directory = directory
+        self.load = load
+        self.name = name
+        self.value = None
+        self.version = None
+        self.lock = threading.Lock()
+
+    def get(self):
+        version = read_current(self.directory)
+        if version is None:
+            return None
+        if version != self.version:
+            with self.lock:
+                if version != self.version:
+                    try:
+                        self.value = self.load(os.path.join(self.directory, version))
+                    except Exception as e:
+                        logger.error(f"Error loading {self.name} {version}: {e}")
+                        self.value = None
+                    self.version = version
+        return self.value